@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for parts of copy_engine.py, on synthetic data under a temporary
+directory (or --dir, e.g. to test against a NAS mount).
+"""
+
+import argparse
+import ctypes
+import mmap
+import os
+from os.path import join
+import tempfile
+import time
+from shutil import copytree, rmtree
+
+import copy_engine
+
+
+def write_random(path, n_bytes, chunk_size=64 * 1024**2):
+    with open(path, 'wb') as f:
+        while n_bytes > 0:
+            n = min(chunk_size, n_bytes)
+            f.write(os.urandom(n))
+            n_bytes -= n
+
+
+def modify_copy(src, dst, modification, size):
+    """
+    Writes a modified version of src to dst.
+    """
+    with open(src, 'rb') as f:
+        data = f.read()
+
+    if modification == 'append_1pct':
+        data = data + os.urandom(size // 100)
+
+    elif modification == 'overwrite_scattered':
+        data = bytearray(data)
+        # 10 separate 4KiB regions
+        for i in range(10):
+            offset = (i * size) // 10 + 1234
+            data[offset:offset + 4096] = os.urandom(4096)
+
+    elif modification == 'insert_middle':
+        middle = size // 2
+        data = data[:middle] + os.urandom(1000) + data[middle:]
+
+    else:
+        raise ValueError(f'unrecognized modification {modification}')
+
+    with open(dst, 'wb') as f:
+        f.write(data)
+
+
+def bench_delta(args, work_dir):
+    size = args.size_mb * 1024**2
+    options = dict(copy_engine.default_copy_options)
+    options['delta_block_kb'] = args.block_kb
+
+    old = join(work_dir, 'old')
+    write_random(old, size)
+
+    print(f'file size: {copy_engine.format_bytes(size)}, '
+        f'block size: {args.block_kb}KiB'
+    )
+    print(f'{"modification":<22}{"sent":>12}{"written":>12}{"sent %":>9}'
+        f'{"delta s":>10}{"full s":>9}'
+    )
+    for modification in ('append_1pct', 'overwrite_scattered', 'insert_middle'):
+        new = join(work_dir, 'new')
+        modify_copy(old, new, modification, size)
+
+        full_dst = join(work_dir, 'full_dst')
+        before = time.time()
+        copy_engine.copy_file(new, full_dst, options)
+        full_s = time.time() - before
+        os.remove(full_dst)
+
+        delta_dst = join(work_dir, 'delta_dst')
+        copy_engine.copy_file(old, delta_dst, options)
+        before = time.time()
+        n_sent, n_written = copy_engine.delta_copy_file(new, delta_dst,
+            options
+        )
+        delta_s = time.time() - before
+
+        with open(new, 'rb') as f, open(delta_dst, 'rb') as g:
+            assert f.read() == g.read(), 'delta copy did not match source'
+        os.remove(delta_dst)
+
+        new_size = os.stat(new).st_size
+        print(f'{modification:<22}{copy_engine.format_bytes(n_sent):>12}'
+            f'{copy_engine.format_bytes(n_written):>12}'
+            f'{100 * n_sent / new_size:>8.2f}%{delta_s:>10.2f}{full_s:>9.2f}'
+        )
+        os.remove(new)
+
+
+def make_tree(root, depth, fanout, files_per_dir, file_size):
+    """
+    Returns (number of directories, number of files) created.
+    """
+    os.makedirs(root)
+    n_dirs, n_files = 1, files_per_dir
+    for i in range(files_per_dir):
+        write_random(join(root, f'f{i}'), file_size)
+
+    if depth > 0:
+        for i in range(fanout):
+            d, f = make_tree(join(root, f'd{i}'), depth - 1, fanout,
+                files_per_dir, file_size
+            )
+            n_dirs += d
+            n_files += f
+
+    return n_dirs, n_files
+
+
+def bench_tree(args, work_dir):
+    src = join(work_dir, 'src')
+    n_dirs, n_files = make_tree(src, args.depth, args.fanout,
+        args.files_per_dir, args.file_kb * 1024
+    )
+    dst_dir = work_dir if args.dst_dir is None else args.dst_dir
+    print(f'{n_dirs} directories (depth {args.depth}), {n_files} files of '
+        f'{args.file_kb}KiB. copying to {dst_dir}'
+    )
+
+    def copy_function(src, dst):
+        copy_engine.copy_file(src, dst)
+
+    print(f'{"tree_workers":<14}{"s":>8}{"dirs/s":>10}{"files/s":>10}')
+    for n_workers in args.workers:
+        dst = tempfile.mkdtemp(prefix='benchmark_tree_', dir=dst_dir)
+        try:
+            before = time.time()
+            if n_workers > 1:
+                copy_engine.copy_tree(src, dst, copy_function, n_workers)
+            else:
+                # What copy_item uses for tree_workers=1.
+                copytree(src, dst, copy_function=copy_function,
+                    dirs_exist_ok=True
+                )
+            s = time.time() - before
+        finally:
+            rmtree(dst)
+
+        print(f'{n_workers:<14}{s:>8.2f}{n_dirs / s:>10.0f}'
+            f'{n_files / s:>10.0f}'
+        )
+
+
+def cached_fraction(path):
+    """
+    Returns fraction of the pages of the file at path that are in the page
+    cache (according to mincore).
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0.0
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+        ctypes.POINTER(ctypes.c_ubyte)
+    ]
+    n_pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+    vec = (ctypes.c_ubyte * n_pages)()
+    with open(path, 'rb') as f:
+        # Copy-on-write, only so ctypes can get the address of the mapping.
+        # Nothing is written, so pages are still those of the page cache.
+        mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_COPY)
+
+    try:
+        start = ctypes.c_char.from_buffer(mm)
+        ret = libc.mincore(ctypes.addressof(start), size, vec)
+        del start
+        if ret != 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+    finally:
+        mm.close()
+
+    return sum(v & 1 for v in vec) / n_pages
+
+
+def read_file(path, chunk_size=8 * 1024**2):
+    with open(path, 'rb') as f:
+        while f.read(chunk_size):
+            pass
+
+
+def bench_page_cache(args, work_dir):
+    working_set = join(work_dir, 'working_set')
+    src = join(work_dir, 'src')
+    write_random(working_set, args.working_set_mb * 1024**2)
+    write_random(src, args.copy_mb * 1024**2)
+    dst_dir = work_dir if args.dst_dir is None else args.dst_dir
+
+    with open('/proc/meminfo') as f:
+        available = [line for line in f if line.startswith('MemAvailable')]
+    print(f'working set (as if used by another process): '
+        f'{args.working_set_mb}MiB. copying {args.copy_mb}MiB to {dst_dir}. '
+        f'{available[0].split(":")[1].strip()} of memory available (copies '
+        'only evict the working set once the page cache fills it).'
+    )
+    print(f'{"drop_page_cache":<17}{"copy s":>8}{"working set hit":>17}'
+        f'{"reread s":>10}{"src cached":>12}{"dst cached":>12}'
+    )
+    for drop_page_cache in (False, True):
+        options = dict(copy_engine.default_copy_options)
+        options['drop_page_cache'] = drop_page_cache
+
+        # The source starts out of the page cache, as it would on a freshly
+        # connected drive, and the working set in it.
+        with open(src, 'rb') as f:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        read_file(working_set)
+
+        dst = join(dst_dir, 'benchmark_page_cache_dst')
+        try:
+            before = time.time()
+            copy_engine.copy_file(src, dst, options=options)
+            copy_s = time.time() - before
+
+            # What any process rereading the working set would hit.
+            hit = cached_fraction(working_set)
+            src_cached = cached_fraction(src)
+            dst_cached = cached_fraction(dst)
+            before = time.time()
+            read_file(working_set)
+            reread_s = time.time() - before
+        finally:
+            os.remove(dst)
+
+        print(f'{str(drop_page_cache):<17}{copy_s:>8.2f}{hit:>17.1%}'
+            f'{reread_s:>10.2f}{src_cached:>12.1%}{dst_cached:>12.1%}'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--dir', help='directory to create test data under '
+        '(default: a new temporary directory)'
+    )
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    delta_parser = subparsers.add_parser('delta', help='bytes transferred by '
+        'delta_copy_file, relative to file size, for a few kinds of changes'
+    )
+    delta_parser.add_argument('--size-mb', type=int, default=256)
+    delta_parser.add_argument('--block-kb', type=int,
+        default=copy_engine.default_copy_options['delta_block_kb']
+    )
+    delta_parser.set_defaults(func=bench_delta)
+
+    tree_parser = subparsers.add_parser('tree', help='copying a deep tree of '
+        'small files with copy_tree (at different numbers of workers) vs '
+        'shutil.copytree'
+    )
+    tree_parser.add_argument('--depth', type=int, default=6)
+    tree_parser.add_argument('--fanout', type=int, default=3)
+    tree_parser.add_argument('--files-per-dir', type=int, default=4)
+    tree_parser.add_argument('--file-kb', type=int, default=16)
+    tree_parser.add_argument('--workers', type=lambda x: [int(n) for n in
+        x.split(',')], default=[1, 2, 4, 8, 16],
+        help='comma separated numbers of workers (1 for shutil.copytree)'
+    )
+    tree_parser.add_argument('--dst-dir', help='directory to copy the tree '
+        'under (e.g. on a NAS mount, where per-directory latency matters). '
+        'defaults to --dir'
+    )
+    tree_parser.set_defaults(func=bench_tree)
+
+    page_cache_parser = subparsers.add_parser('page_cache', help='how much of '
+        'a working set stays in the page cache while copying a large file, '
+        'with and without drop_page_cache (Linux only)'
+    )
+    page_cache_parser.add_argument('--working-set-mb', type=int, default=512)
+    page_cache_parser.add_argument('--copy-mb', type=int, default=4096,
+        help='should be more than the free memory for the working set to be '
+        'evicted without drop_page_cache'
+    )
+    page_cache_parser.add_argument('--dst-dir', help='directory to copy to. '
+        'defaults to --dir'
+    )
+    page_cache_parser.set_defaults(func=bench_page_cache)
+
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark_copy_', dir=args.dir)
+    try:
+        args.func(args, work_dir)
+    finally:
+        rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
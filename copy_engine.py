@@ -0,0 +1,2255 @@
+# -*- coding: utf-8 -*-
+"""
+Copying code used by the rule loop in linux_on_usb_connect.py (a few of the
+helpers are also used by windows_on_usb_connect.py)
+"""
+
+from collections import deque
+import ctypes
+import errno
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+from os.path import (exists, isdir, isfile, split, join, relpath,
+    normpath
+)
+import shutil
+from shutil import copytree, copystat, rmtree
+from concurrent.futures import (ThreadPoolExecutor, wait, as_completed,
+    FIRST_COMPLETED
+)
+import threading
+import time
+import zlib
+
+
+l = logging.getLogger(__name__)
+
+# Any of these can be set at the top level of a drive's *_config.yaml, to apply
+# to all of its rules, or within a particular rule, to override that value.
+default_copy_options = {
+    # Number of items in a rule that are copied at the same time.
+    'n_workers': 1,
+    # Files at least this large are copied as separate byte ranges, with
+    # large_file_workers threads copying ranges at the same time.
+    'large_file_threshold_mb': 1024,
+    'large_file_chunk_mb': 64,
+    'large_file_workers': 4,
+    # 'auto' tries each of copy_backends in order (falling back from
+    # kernel-side copies when the filesystems involved don't support them).
+    # Can also be the name of one of copy_backends.
+    'copy_backend': 'auto',
+    # Largest amount of data moved by each call the backends make.
+    'copy_chunk_mb': 64,
+    # The pipelined backend reads into / writes from buffers of this size, and
+    # the buffers (shared across all copies) use at most buffer_budget_mb.
+    'pipeline_buffer_mb': 8,
+    'buffer_budget_mb': 256,
+    # Whether to keep track of which files have finished copying, so that
+    # interrupted copies can be resumed on the next connection.
+    'journal': True,
+    # Whether to copy each item under a hidden name, only renaming it to its
+    # final name once it has been completely copied.
+    'staging': True,
+    # Whether to tell the kernel (with posix_fadvise, where available) that
+    # files are read sequentially, and that the pages of both the source and
+    # destination files already copied won't be needed again, so copies don't
+    # push everything else out of the page cache.
+    'drop_page_cache': False,
+    # Whether to allocate space for each destination file of at least
+    # preallocate_threshold_mb (where the filesystem supports it) before
+    # writing it, so it isn't grown (and fragmented) chunk by chunk.
+    'preallocate': True,
+    'preallocate_threshold_mb': 1,
+    # Whether to also go through items that already exist at the destination,
+    # copying any files in them that are missing or differ in size or mtime.
+    'sync': False,
+    # When syncing, files at least this large that exist at the destination but
+    # differ are updated rsync-style, only writing the parts that changed.
+    'delta': True,
+    'delta_threshold_mb': 64,
+    'delta_block_kb': 64,
+    # How far past a changed block to look for data that was shifted by an
+    # insertion / deletion.
+    'delta_search_kb': 64,
+    # Name of a hashlib algorithm (e.g. blake2b, sha256) to hash each file with
+    # as it is copied, writing a .<item>.<algorithm> manifest next to each item.
+    # Hashing requires data to pass through Python (no kernel-side copies).
+    'hash': None,
+    # 'full' rereads each copied file at the destination, to check its hash.
+    # 'sampled' checks size and mtime, and compares the first and last blocks,
+    # plus verify_sample_blocks others, between source and destination.
+    # 'none' only checks that each item exists after it is copied.
+    'verify': 'none',
+    'verify_sample_blocks': 8,
+    'verify_sample_kb': 256,
+    # How many items the scan of a rule's source can get ahead of the copies.
+    'scan_queue_size': 64,
+    # Number of threads each directory item is copied with, listing / creating
+    # its subdirectories at the same time as copying its files. 1 to copy one
+    # directory at a time (with shutil.copytree).
+    'tree_workers': 8,
+    # Whether to adjust the number of items copied at once (starting from
+    # n_workers) to the throughput measured over each adaptive_window_s
+    # seconds: adding a worker at a time while throughput holds up, and cutting
+    # the number of workers by adaptive_decrease_factor when it drops (by more
+    # than adaptive_tolerance, as a fraction).
+    'adaptive_workers': False,
+    'min_workers': 1,
+    'max_workers': 8,
+    'adaptive_window_s': 5,
+    'adaptive_decrease_factor': 0.5,
+    'adaptive_tolerance': 0.1,
+}
+
+
+def get_copy_options(config, rule):
+    """
+    Returns dict w/ values from rule, then config (top-level), then defaults.
+    """
+    options = dict()
+    for k, v in default_copy_options.items():
+        if k in rule:
+            options[k] = rule[k]
+        elif k in config:
+            options[k] = config[k]
+        else:
+            options[k] = v
+
+    return options
+
+
+class _BackendUnsupported(Exception):
+    pass
+
+
+# What copy_file_range / sendfile fail with (on the first call) when the pair
+# of filesystems (or the kernel) doesn't support them.
+_unsupported_errnos = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP,
+    errno.EINVAL, errno.EBADF
+}
+
+
+def _copy_range_copy_file_range(src_fd, dst_fd, offset, length, options,
+    hasher=None, on_progress=None):
+    # Data stays in the kernel (and may be copied server-side on NFS >= 4.2).
+    chunk_size = options['copy_chunk_mb'] * 1024**2
+    end = offset + length
+    first_call = True
+    while offset < end:
+        try:
+            n_copied = os.copy_file_range(src_fd, dst_fd,
+                min(chunk_size, end - offset), offset, offset
+            )
+        except OSError as e:
+            if first_call and e.errno in _unsupported_errnos:
+                raise _BackendUnsupported(str(e))
+            raise
+
+        if n_copied == 0:
+            # Some filesystems return 0 rather than failing.
+            if first_call:
+                raise _BackendUnsupported('copy_file_range copied nothing')
+            raise IOError(f'source ended early (at byte {offset})')
+
+        first_call = False
+        offset += n_copied
+        if on_progress is not None:
+            on_progress(n_copied)
+
+
+def _copy_range_sendfile(src_fd, dst_fd, offset, length, options,
+    hasher=None, on_progress=None):
+    # Writes at the current position of dst_fd, so this can not be used to copy
+    # multiple ranges of one file at once.
+    chunk_size = options['copy_chunk_mb'] * 1024**2
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    end = offset + length
+    first_call = True
+    while offset < end:
+        try:
+            n_copied = os.sendfile(dst_fd, src_fd, offset,
+                min(chunk_size, end - offset)
+            )
+        except OSError as e:
+            if first_call and e.errno in _unsupported_errnos:
+                raise _BackendUnsupported(str(e))
+            raise
+
+        if n_copied == 0:
+            if first_call:
+                raise _BackendUnsupported('sendfile copied nothing')
+            raise IOError(f'source ended early (at byte {offset})')
+
+        first_call = False
+        offset += n_copied
+        if on_progress is not None:
+            on_progress(n_copied)
+
+
+def _copy_range_userspace(src_fd, dst_fd, offset, length, options,
+    hasher=None, on_progress=None):
+    chunk_size = options['copy_chunk_mb'] * 1024**2
+    end = offset + length
+    while offset < end:
+        data = os.pread(src_fd, min(chunk_size, end - offset), offset)
+        if len(data) == 0:
+            raise IOError(f'source ended early (at byte {offset})')
+
+        if hasher is not None:
+            hasher.update(data)
+
+        # pwrite may write less than it was passed.
+        data = memoryview(data)
+        n_bytes = len(data)
+        while len(data) > 0:
+            n_written = os.pwrite(dst_fd, data, offset)
+            data = data[n_written:]
+            offset += n_written
+
+        if on_progress is not None:
+            on_progress(n_bytes)
+
+
+class BufferPool:
+    """
+    Fixed set of preallocated buffers, shared by all pipelined copies using the
+    same settings, so that their total memory use is capped.
+    """
+    def __init__(self, buffer_size, n_buffers):
+        self.buffer_size = buffer_size
+        self._free = queue.Queue()
+        for _ in range(n_buffers):
+            self._free.put(bytearray(buffer_size))
+
+
+    def get(self):
+        # Blocks until another copy returns a buffer, if none are free.
+        return self._free.get()
+
+
+    def put(self, buf):
+        self._free.put(buf)
+
+
+# (buffer size, number of buffers) -> BufferPool
+_buffer_pools = dict()
+_buffer_pools_lock = threading.Lock()
+
+
+def _get_buffer_pool(options):
+    buffer_mb = options['pipeline_buffer_mb']
+    buffer_size = buffer_mb * 1024**2
+    # At least two, so reading and writing can still overlap.
+    n_buffers = max(options['buffer_budget_mb'] // buffer_mb, 2)
+    key = (buffer_size, n_buffers)
+    with _buffer_pools_lock:
+        if key not in _buffer_pools:
+            l.info(f'allocating {n_buffers} copy buffers of {buffer_mb}MiB')
+            _buffer_pools[key] = BufferPool(buffer_size, n_buffers)
+
+        return _buffer_pools[key]
+
+
+def _copy_range_pipelined(src_fd, dst_fd, offset, length, options,
+    hasher=None, on_progress=None):
+    # Reads (into buffers from the pool) in this thread, while another thread
+    # writes out buffers that have already been filled, so a slow destination
+    # does not leave the source idle (and vice versa). If hashing, a third
+    # thread hashes buffers after they are written, so that hashing does not
+    # hold up either.
+    pool = _get_buffer_pool(options)
+    filled = queue.Queue()
+    written = queue.Queue()
+    errors = []
+
+    def write_filled():
+        while True:
+            item = filled.get()
+            if item is None:
+                written.put(None)
+                return
+
+            buf, n_bytes, buf_offset = item
+            try:
+                # Still need to pass on the remaining buffers after an error,
+                # but don't need to write them.
+                if len(errors) == 0:
+                    view = memoryview(buf)[:n_bytes]
+                    while len(view) > 0:
+                        n_written = os.pwrite(dst_fd, view, buf_offset)
+                        view = view[n_written:]
+                        buf_offset += n_written
+
+                    if on_progress is not None:
+                        on_progress(n_bytes)
+
+            except Exception as e:
+                errors.append(e)
+
+            finally:
+                if hasher is None:
+                    pool.put(buf)
+                else:
+                    written.put((buf, n_bytes))
+
+    def hash_written():
+        while True:
+            item = written.get()
+            if item is None:
+                return
+
+            buf, n_bytes = item
+            try:
+                if len(errors) == 0:
+                    hasher.update(memoryview(buf)[:n_bytes])
+
+            except Exception as e:
+                errors.append(e)
+
+            finally:
+                pool.put(buf)
+
+    threads = [threading.Thread(target=write_filled, daemon=True)]
+    if hasher is not None:
+        threads.append(threading.Thread(target=hash_written, daemon=True))
+
+    for thread in threads:
+        thread.start()
+
+    end = offset + length
+    try:
+        while offset < end and len(errors) == 0:
+            buf = pool.get()
+            try:
+                n_bytes = os.preadv(src_fd,
+                    [memoryview(buf)[:min(pool.buffer_size, end - offset)]],
+                    offset
+                )
+                if n_bytes == 0:
+                    raise IOError(f'source ended early (at byte {offset})')
+
+            except Exception:
+                pool.put(buf)
+                raise
+
+            filled.put((buf, n_bytes, offset))
+            offset += n_bytes
+
+    finally:
+        filled.put(None)
+        for thread in threads:
+            thread.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+
+# In the order they are tried by the 'auto' backend. Each should copy
+# [offset, offset + length) of the source to the same range of the destination,
+# raising _BackendUnsupported only if nothing was copied, and calling
+# on_progress (if passed) with the number of bytes copied after each chunk.
+# Those in _hashing_backends also update hasher (if passed) with the data they
+# copy, in order. The others never have data pass through Python.
+copy_backends = {
+    'copy_file_range': _copy_range_copy_file_range,
+    'sendfile': _copy_range_sendfile,
+    'pipelined': _copy_range_pipelined,
+    'userspace': _copy_range_userspace,
+}
+_hashing_backends = {'pipelined', 'userspace'}
+# Backends that can not have multiple ranges of one file copied at once.
+_non_positional_backends = {'sendfile'}
+
+# (source st_dev, destination st_dev) -> set of names of backends that were not
+# supported between those filesystems. Only what the filesystems can do is
+# remembered, not which backend was used, as that depends on options (e.g.
+# copy_backend, hashing, or whether ranges are copied at once).
+_dev_pair2unsupported = dict()
+_dev_pair2unsupported_lock = threading.Lock()
+
+# Destination st_dev of filesystems that fallocate failed on.
+_devs_without_fallocate = set()
+# libc's fallocate64, or False if there isn't one (None until looked up).
+_libc_fallocate = None
+
+
+def _fallocate(fd, length):
+    """
+    Allocates [0, length) of the file fd (extending it to length), raising
+    OSError if the filesystem (or platform) doesn't support that.
+
+    Unlike os.posix_fallocate, which glibc falls back to emulating by writing
+    zeros over the whole file, this never writes anything.
+    """
+    global _libc_fallocate
+    if _libc_fallocate is None:
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+        # e.g. on Windows
+        except (OSError, TypeError):
+            libc = None
+        _libc_fallocate = getattr(libc, 'fallocate64', False)
+        if _libc_fallocate:
+            _libc_fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                ctypes.c_int64, ctypes.c_int64
+            ]
+
+    if not _libc_fallocate:
+        raise OSError(errno.ENOSYS, 'fallocate not available')
+
+    if _libc_fallocate(fd, 0, 0, length) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+
+def _preallocate(fd, size, dst_dev, dst):
+    """
+    Returns whether the space for the file fd was allocated. Raises only if the
+    filesystem supports it, but there was some other problem (e.g. no space).
+    """
+    if dst_dev in _devs_without_fallocate:
+        return False
+
+    try:
+        _fallocate(fd, size)
+        return True
+
+    except OSError as e:
+        if e.errno not in _unsupported_errnos:
+            raise
+
+        l.info(f'preallocating not supported where {dst} is ({e}). not '
+            'preallocating there.'
+        )
+        _devs_without_fallocate.add(dst_dev)
+        return False
+
+
+_can_fadvise = hasattr(os, 'posix_fadvise')
+# How much is copied between telling the kernel to drop what has been copied.
+_drop_page_cache_every = 16 * 1024**2
+
+
+def _fadvise(fd, offset, length, advice):
+    # Only a hint, so not worth failing a copy over.
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError as e:
+        l.debug(f'posix_fadvise failed ({e})')
+
+
+def _dropping_behind(src_fd, dst_fd, offset, on_progress=None):
+    """
+    Returns function to pass as on_progress to a backend copying a range
+    starting at offset, which drops (from the page cache) pages of both files
+    behind what has been copied, and calls on_progress (if passed).
+
+    Dirty destination pages can't be dropped until they are written back, which
+    asking to drop them starts, so each range of the destination is asked to
+    be dropped twice: once when it has just been written, and again after the
+    next range has been.
+    """
+    # [dropped, cursor) has been copied, but not asked to be dropped, and
+    # [dst_dropped, dropped) of the destination has only been asked once.
+    cursor = offset
+    dropped = offset
+    dst_dropped = offset
+    def progress(n_bytes):
+        nonlocal cursor, dropped, dst_dropped
+        cursor += n_bytes
+        if cursor - dropped >= _drop_page_cache_every:
+            _fadvise(src_fd, dropped, cursor - dropped,
+                os.POSIX_FADV_DONTNEED
+            )
+            _fadvise(dst_fd, dst_dropped, cursor - dst_dropped,
+                os.POSIX_FADV_DONTNEED
+            )
+            dst_dropped = dropped
+            dropped = cursor
+
+        if on_progress is not None:
+            on_progress(n_bytes)
+
+    return progress
+
+
+def _backend_candidates(backend, positional=False):
+    if backend == 'auto':
+        candidates = list(copy_backends.keys())
+    elif backend in copy_backends:
+        candidates = [backend]
+        if backend != 'userspace':
+            candidates.append('userspace')
+    else:
+        raise ValueError(f'unrecognized copy_backend {backend}. must be auto '
+            f'or one of {list(copy_backends.keys())}'
+        )
+
+    if positional:
+        candidates = [b for b in candidates
+            if b not in _non_positional_backends
+        ]
+
+    return candidates
+
+
+def _copy_first_range(src_fd, dst_fd, offset, length, candidates, options,
+    hasher=None, on_progress=None, dev_pair=None):
+    """
+    Returns name of the first backend in candidates that could copy the range.
+    Backends that are not supported are remembered for dev_pair, if passed.
+    """
+    for backend in candidates:
+        try:
+            copy_backends[backend](src_fd, dst_fd, offset, length, options,
+                hasher=hasher, on_progress=on_progress
+            )
+            return backend
+
+        except _BackendUnsupported as e:
+            l.info(f'copy backend {backend} not supported here ({e}). falling '
+                'back to next backend.'
+            )
+            if dev_pair is not None:
+                with _dev_pair2unsupported_lock:
+                    _dev_pair2unsupported.setdefault(dev_pair, set()).add(
+                        backend
+                    )
+
+    raise IOError(f'none of the copy backends {candidates} worked')
+
+
+def copy_file(src, dst, options=None, hasher=None, on_progress=None):
+    """
+    Copies one file, like copy2, returning the name of the copy backend used.
+
+    Files at least options['large_file_threshold_mb'] large are copied as
+    separate byte ranges, options['large_file_workers'] at a time, into a
+    destination that is first sized to match the source. Destinations are also
+    sized first when preallocating (see options['preallocate']). Either way, if
+    the copy fails, the destination is truncated to what was actually copied.
+
+    If hasher (e.g. from hashlib.new) is passed, it is updated with the contents
+    of the file as they are copied. If on_progress is passed, it is called
+    (possibly from several threads at once) with the number of bytes copied
+    as each chunk is copied.
+
+    If options['drop_page_cache'] is set, both files are dropped from the page
+    cache as they are copied (see _dropping_behind), and once the copy is done.
+    """
+    if options is None:
+        options = default_copy_options
+
+    src_stat = os.stat(src)
+    size = src_stat.st_size
+
+    threshold = options['large_file_threshold_mb'] * 1024**2
+    n_workers = options['large_file_workers']
+    # Data has to be hashed in order, so it can't be copied as separate ranges.
+    if n_workers > 1 and size >= threshold and hasher is None:
+        range_size = options['large_file_chunk_mb'] * 1024**2
+    else:
+        n_workers = 1
+        range_size = max(size, 1)
+
+    ranges = [(offset, min(range_size, size - offset))
+        for offset in range(0, size, range_size)
+    ]
+    candidates = _backend_candidates(options['copy_backend'],
+        positional=n_workers > 1
+    )
+    if hasher is not None:
+        candidates = [b for b in candidates if b in _hashing_backends]
+
+    backend = None
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        src_fd = fsrc.fileno()
+        dst_fd = fdst.fileno()
+
+        dev_pair = (src_stat.st_dev, os.fstat(dst_fd).st_dev)
+        with _dev_pair2unsupported_lock:
+            unsupported = set(_dev_pair2unsupported.get(dev_pair, ()))
+
+        # Skipping backends that already failed between these filesystems.
+        # userspace is always supported, and is the last of any candidates.
+        candidates = [b for b in candidates if b not in unsupported]
+
+        drop_page_cache = options['drop_page_cache'] and _can_fadvise
+        # offset of each range -> bytes copied from the start of it so far.
+        # Each range is copied in order, by one thread.
+        range2n_copied = {offset: 0 for offset, _ in ranges}
+        def range_progress(offset):
+            progress = on_progress
+            if drop_page_cache:
+                progress = _dropping_behind(src_fd, dst_fd, offset, progress)
+
+            def count_copied(n_bytes):
+                range2n_copied[offset] += n_bytes
+                if progress is not None:
+                    progress(n_bytes)
+
+            return count_copied
+
+        if drop_page_cache:
+            # Doubles readahead on Linux.
+            _fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        # Whether the destination was already extended to its final size.
+        sized = False
+        if (options['preallocate'] and
+            size >= options['preallocate_threshold_mb'] * 1024**2):
+
+            sized = _preallocate(dst_fd, size, dev_pair[1], dst)
+
+        if n_workers > 1:
+            l.info(f'copying {src} ({size / 1024**2:.0f}MiB) as {len(ranges)} '
+                f'ranges, with {n_workers} workers'
+            )
+            if not sized:
+                os.ftruncate(dst_fd, size)
+                sized = True
+
+        try:
+            if len(ranges) > 0:
+                # Doing this range alone first, so we know which backend works
+                # for the rest.
+                offset, length = ranges[0]
+                backend = _copy_first_range(src_fd, dst_fd, offset, length,
+                    candidates, options, hasher=hasher,
+                    on_progress=range_progress(offset), dev_pair=dev_pair
+                )
+
+            if len(ranges) > 1:
+                copy_range = copy_backends[backend]
+                with ThreadPoolExecutor(max_workers=n_workers) as pool:
+                    future2length = {pool.submit(copy_range, src_fd, dst_fd,
+                        offset, length, options,
+                        on_progress=range_progress(offset)): length
+                        for offset, length in ranges[1:]
+                    }
+                    try:
+                        n_bytes_done = ranges[0][1]
+                        last_logged_pct = 0
+                        for future in as_completed(future2length):
+                            future.result()
+                            n_bytes_done += future2length[future]
+
+                            pct = 100 * n_bytes_done / size
+                            if (pct - last_logged_pct >= 10 or
+                                n_bytes_done == size):
+
+                                l.info(f'{src}: {pct:.0f}% copied')
+                                last_logged_pct = pct
+                    finally:
+                        for future in future2length:
+                            future.cancel()
+        except BaseException:
+            # So the file does not have the size of a complete copy (with the
+            # end never written). Each range is copied from its start, so
+            # what was copied ends at the first range that was not finished.
+            if sized:
+                n_copied = 0
+                for offset, length in ranges:
+                    n_copied += range2n_copied[offset]
+                    if range2n_copied[offset] < length:
+                        break
+
+                os.ftruncate(dst_fd, n_copied)
+            raise
+
+        # Including whatever was copied since the last chunk was dropped. The
+        # last of the destination may stay cached until it is written back.
+        if drop_page_cache:
+            _fadvise(src_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            _fadvise(dst_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    copystat(src, dst)
+
+    return backend
+
+
+def _block_signatures(path, block_size):
+    """
+    Returns dict of weak (adler32) checksum -> list of (block index, strong
+    hash) for each block of the file at path.
+    """
+    weak2blocks = dict()
+    with open(path, 'rb') as f:
+        index = 0
+        while True:
+            block = f.read(block_size)
+            if len(block) == 0:
+                break
+
+            weak = zlib.adler32(block)
+            strong = hashlib.blake2b(block, digest_size=16).digest()
+            weak2blocks.setdefault(weak, []).append((index, strong))
+            index += 1
+
+    return weak2blocks
+
+
+def _match_block(block, weak, weak2blocks, preferred_index):
+    """
+    Returns index of a destination block with the same contents, or None.
+    """
+    candidates = weak2blocks.get(weak)
+    if candidates is None:
+        return None
+
+    strong = hashlib.blake2b(block, digest_size=16).digest()
+    matches = [index for index, s in candidates if s == strong]
+    if len(matches) == 0:
+        return None
+
+    if preferred_index in matches:
+        return preferred_index
+
+    return matches[0]
+
+
+def _rolling_search(data, a, b, block_size, weak2blocks):
+    """
+    Slides a block_size window along data (starting at data[:block_size],
+    whose adler32 components are a and b) one byte at a time, returning the
+    (shift, matching destination block index) of the first match, or None.
+    """
+    mod = 65521
+    for shift in range(1, len(data) - block_size + 1):
+        x_out = data[shift - 1]
+        x_in = data[shift + block_size - 1]
+        a = (a - x_out + x_in) % mod
+        b = (b - block_size * x_out + a - 1) % mod
+
+        weak = (b << 16) | a
+        if weak in weak2blocks:
+            block = data[shift:shift + block_size]
+            index = _match_block(block, weak, weak2blocks, None)
+            if index is not None:
+                return shift, index
+
+    return None
+
+
+def compute_delta(src, weak2blocks, block_size, search_size,
+    max_failed_searches=8):
+    """
+    Returns list of ('match', src_offset, dst_offset, length) and
+    ('literal', src_offset, length) operations that would rebuild src from
+    blocks of the destination (described by weak2blocks) plus literal data.
+
+    Blocks are first compared at their current position, and when that fails,
+    a rolling checksum is used to find matching blocks up to search_size bytes
+    further along (to handle data inserted or removed in src). After
+    max_failed_searches searches in a row find nothing, only block aligned
+    comparisons are made until something matches again.
+    """
+    ops = []
+    size = os.stat(src).st_size
+    with open(src, 'rb') as f:
+        fd = f.fileno()
+
+        pos = 0
+        literal_start = 0
+        n_failed_searches = 0
+
+        def add_match(pos, index, length):
+            if literal_start < pos:
+                ops.append(('literal', literal_start, pos - literal_start))
+
+            dst_offset = index * block_size
+            # Merging runs of contiguous matching blocks.
+            if len(ops) > 0 and ops[-1][0] == 'match':
+                _, last_src, last_dst, last_length = ops[-1]
+                if (last_src + last_length == pos and
+                    last_dst + last_length == dst_offset):
+                    ops[-1] = ('match', last_src, last_dst,
+                        last_length + length
+                    )
+                    return
+
+            ops.append(('match', pos, dst_offset, length))
+
+        while pos < size:
+            search = (n_failed_searches < max_failed_searches and
+                pos + block_size < size
+            )
+            data = os.pread(fd, block_size + (search_size if search else 0),
+                pos
+            )
+            block = data[:block_size]
+            weak = zlib.adler32(block)
+            preferred_index = pos // block_size \
+                if pos % block_size == 0 else None
+
+            index = _match_block(block, weak, weak2blocks, preferred_index)
+            if index is not None:
+                add_match(pos, index, len(block))
+                pos += len(block)
+                literal_start = pos
+                n_failed_searches = 0
+                continue
+
+            if not search or len(data) <= block_size:
+                pos += len(block)
+                continue
+
+            found = _rolling_search(data, weak & 0xffff, weak >> 16,
+                block_size, weak2blocks
+            )
+            if found is None:
+                n_failed_searches += 1
+                pos += len(data) - block_size + 1
+                continue
+
+            shift, index = found
+            pos += shift
+            add_match(pos, index, block_size)
+            pos += block_size
+            literal_start = pos
+            n_failed_searches = 0
+
+        if literal_start < size:
+            ops.append(('literal', literal_start, size - literal_start))
+
+    return ops
+
+
+def _write_from(src_fd, dst_fd, src_offset, dst_offset, length, bufsize):
+    end = src_offset + length
+    while src_offset < end:
+        data = os.pread(src_fd, min(bufsize, end - src_offset), src_offset)
+        if len(data) == 0:
+            raise IOError(f'source ended early (at byte {src_offset})')
+
+        data = memoryview(data)
+        while len(data) > 0:
+            n_written = os.pwrite(dst_fd, data, dst_offset)
+            data = data[n_written:]
+            src_offset += n_written
+            dst_offset += n_written
+
+
+def delta_copy_file(src, dst, options=None):
+    """
+    Updates existing file dst to match src, rsync-style, only transferring the
+    parts of src that do not match blocks dst already has.
+
+    Returns number of bytes sent from src (not matching anything in dst) and
+    number of bytes written to dst.
+    """
+    if options is None:
+        options = default_copy_options
+
+    block_size = options['delta_block_kb'] * 1024
+    search_size = options['delta_search_kb'] * 1024
+    bufsize = options['copy_chunk_mb'] * 1024**2
+
+    weak2blocks = _block_signatures(dst, block_size)
+    ops = compute_delta(src, weak2blocks, block_size, search_size)
+
+    size = os.stat(src).st_size
+    n_literal_bytes = sum(op[-1] for op in ops if op[0] == 'literal')
+
+    # Can then just overwrite the parts that changed.
+    in_place = all(op[1] == op[2] for op in ops if op[0] == 'match')
+    if in_place:
+        n_bytes_written = n_literal_bytes
+        with open(src, 'rb') as fsrc, open(dst, 'r+b') as fdst:
+            src_fd = fsrc.fileno()
+            dst_fd = fdst.fileno()
+            for op in ops:
+                if op[0] == 'literal':
+                    _, offset, length = op
+                    _write_from(src_fd, dst_fd, offset, offset, length, bufsize)
+
+            os.ftruncate(dst_fd, size)
+
+    # Otherwise, blocks that moved might be overwritten before we read them, so
+    # building the new file next to the old one, from both files.
+    else:
+        n_bytes_written = size
+        tmp_dst = staging_path(dst)
+        with open(src, 'rb') as fsrc, open(dst, 'rb') as fold, \
+            open(tmp_dst, 'wb') as fdst:
+
+            src_fd = fsrc.fileno()
+            old_fd = fold.fileno()
+            dst_fd = fdst.fileno()
+            for op in ops:
+                if op[0] == 'literal':
+                    _, offset, length = op
+                    _write_from(src_fd, dst_fd, offset, offset, length, bufsize)
+                else:
+                    _, offset, old_offset, length = op
+                    _write_from(old_fd, dst_fd, old_offset, offset, length,
+                        bufsize
+                    )
+
+        os.replace(tmp_dst, dst)
+
+    copystat(src, dst)
+
+    l.info(f'delta copied {src} ({format_bytes(size)}): sent '
+        f'{format_bytes(n_literal_bytes)} of new data, wrote '
+        f'{format_bytes(n_bytes_written)}'
+        + ('' if in_place else ' (rebuilt, because data moved)')
+    )
+    return n_literal_bytes, n_bytes_written
+
+
+def journal_path(dst_item):
+    """
+    Returns path of the (hidden) journal file for copying to dst_item, which
+    only exists while that copy is incomplete.
+    """
+    parent, name = split(dst_item)
+    return join(parent, f'.{name}.copy_journal')
+
+
+def has_journal(dst_item):
+    return exists(journal_path(dst_item))
+
+
+def read_journal(path):
+    """
+    Returns (done, digests) dicts for the journal at path (see CopyJournal).
+    """
+    done = dict()
+    digests = dict()
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            # Last line may be cut off if we were killed writing it.
+            except ValueError:
+                continue
+
+            if entry['done']:
+                done[entry['path']] = (entry['size'], entry['mtime'])
+                digests[entry['path']] = entry.get('digest')
+            else:
+                done.pop(entry['path'], None)
+
+    return done, digests
+
+
+class CopyJournal:
+    """
+    Per-file completion state for the copy of one item, so that a copy that was
+    interrupted can later be resumed, without recopying finished files.
+
+    Each line of the journal file is JSON with the path (relative to the item),
+    size and mtime of a source file, and whether it was finished copying.
+    Later lines for a path replace earlier ones.
+    """
+    def __init__(self, path, resuming=None):
+        """
+        resuming can be passed if it is already known whether path exists.
+        """
+        self.path = path
+        # relative path -> (size, mtime) of source when it finished copying
+        self.done = dict()
+        # relative path -> hex digest of finished file, if hashing
+        self.digests = dict()
+        self.resuming = exists(path) if resuming is None else resuming
+        if self.resuming:
+            self.done, self.digests = read_journal(path)
+
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+
+    def is_done(self, rel_path, src_stat, dst):
+        """
+        Whether rel_path was already copied to dst, from a source that still
+        has the same size and mtime.
+        """
+        with self._lock:
+            if self.done.get(rel_path) != (src_stat.st_size,
+                src_stat.st_mtime):
+                return False
+
+        try:
+            return os.stat(dst).st_size == src_stat.st_size
+        except FileNotFoundError:
+            return False
+
+
+    def record(self, rel_path, src_stat, done, digest=None):
+        entry = {
+            'path': rel_path,
+            'size': src_stat.st_size,
+            'mtime': src_stat.st_mtime,
+            'done': done,
+            'digest': digest
+        }
+        with self._lock:
+            if done:
+                self.done[rel_path] = (src_stat.st_size, src_stat.st_mtime)
+                self.digests[rel_path] = digest
+
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+
+
+    def close(self, delete=False):
+        self._file.close()
+        if delete:
+            os.remove(self.path)
+
+
+def hash_algorithm(options):
+    """
+    Returns name of the hashlib algorithm to hash copied files with, or None.
+    """
+    if options['hash'] is not None:
+        return options['hash']
+
+    # Need something to compare the reread destination to.
+    if options['verify'] == 'full':
+        return 'blake2b'
+
+    return None
+
+
+def hash_file(path, algorithm, bufsize=8 * 1024**2):
+    hasher = hashlib.new(algorithm)
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n_bytes = f.readinto(buf)
+            if n_bytes == 0:
+                break
+
+            hasher.update(view[:n_bytes])
+
+    return hasher.hexdigest()
+
+
+def manifest_path(dst_item, algorithm):
+    """
+    Returns path of the (hidden) manifest of hashes of the files in dst_item.
+
+    The manifest is in the same format as sha256sum / b2sum etc output, with
+    paths relative to the directory containing dst_item, so it can be checked
+    with e.g. `b2sum -c .<item>.blake2b` from that directory.
+    """
+    parent, name = split(dst_item)
+    return join(parent, f'.{name}.{algorithm}')
+
+
+def read_manifest(path):
+    """
+    Returns dict of path -> hex digest.
+    """
+    path2digest = dict()
+    with open(path, 'r') as f:
+        for line in f:
+            digest, file_path = line.rstrip('\n').split('  ', 1)
+            path2digest[file_path] = digest
+
+    return path2digest
+
+
+def write_manifest(path, path2digest):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for file_path, digest in sorted(path2digest.items()):
+            f.write(f'{digest}  {file_path}\n')
+
+    os.replace(tmp_path, path)
+
+
+def write_item_manifest(src_item, dst_item, algorithm, digests):
+    """
+    digests should be a dict of paths (relative to src_item) to hex digests,
+    for every file in the item, with None for files that were not hashed this
+    time (whose digests are taken from any earlier manifest, or computed, and
+    filled in to digests).
+    """
+    path = manifest_path(dst_item, algorithm)
+    old_path2digest = read_manifest(path) if exists(path) else dict()
+
+    name = split(dst_item)[1]
+    path2digest = dict()
+    n_hashed_again = 0
+    for rel_path, digest in digests.items():
+        manifest_rel_path = name if rel_path == '.' else join(name, rel_path)
+        if digest is None:
+            digest = old_path2digest.get(manifest_rel_path)
+
+        if digest is None:
+            src = src_item if rel_path == '.' else join(src_item, rel_path)
+            digest = hash_file(src, algorithm)
+            n_hashed_again += 1
+
+        digests[rel_path] = digest
+        path2digest[manifest_rel_path] = digest
+
+    if n_hashed_again > 0:
+        l.info(f'had to hash {n_hashed_again} skipped files under {src_item} '
+            'for manifest'
+        )
+
+    write_manifest(path, path2digest)
+    l.info(f'wrote {path}')
+
+
+def _sample_offsets(size, block_size, n_random, seed):
+    """
+    Returns sorted offsets of the first and last blocks, and n_random others,
+    chosen pseudo-randomly (but always the same for the same seed).
+    """
+    if size <= block_size * (n_random + 2):
+        # Cheaper to just compare everything.
+        return list(range(0, size, block_size))
+
+    rng = random.Random(seed)
+    last = size - block_size
+    offsets = {0, last}
+    offsets.update(rng.randrange(0, last) for _ in range(n_random))
+    return sorted(offsets)
+
+
+def sampled_match(src, dst, options, rel_path=None):
+    """
+    Returns None if dst has the same size and (~) mtime as src, and the same
+    contents in a sample of blocks. Otherwise, returns a description of the
+    first difference found.
+
+    rel_path should be the path of src relative to the item it is in (the name
+    of src, if None), and decides (with the size) which blocks are sampled.
+    """
+    src_stat = os.stat(src)
+    if not is_up_to_date(src_stat, dst):
+        return 'size or mtime differed'
+
+    block_size = options['verify_sample_kb'] * 1024
+    if rel_path is None:
+        rel_path = split(src)[1]
+
+    # Seeding with the path within the item (rather than just the name, which
+    # e.g. every Image_001_001.raw shares), so different files get different
+    # samples, but the same file gets the same sample wherever it is copied.
+    offsets = _sample_offsets(src_stat.st_size, block_size,
+        options['verify_sample_blocks'], f'{rel_path}{src_stat.st_size}'
+    )
+    with open(src, 'rb') as fsrc, open(dst, 'rb') as fdst:
+        for offset in offsets:
+            src_block = os.pread(fsrc.fileno(), block_size, offset)
+            dst_block = os.pread(fdst.fileno(), block_size, offset)
+            if (hashlib.blake2b(src_block).digest() !=
+                hashlib.blake2b(dst_block).digest()):
+                return f'block at byte {offset} differed'
+
+    return None
+
+
+def staging_path(dst_item):
+    """
+    Returns the (hidden) path dst_item is copied to before being renamed to
+    dst_item, so anything at dst_item is known to have been completely copied.
+    """
+    parent, name = split(dst_item)
+    return join(parent, f'.{name}.staging')
+
+
+def _staged_name(name):
+    """
+    Returns the final name of an item, if name is that of one being staged.
+    """
+    prefix = '.'
+    suffix = '.staging'
+    if name.startswith(prefix) and name.endswith(suffix):
+        return name[len(prefix):-len(suffix)]
+
+    return None
+
+
+def find_staged(dst):
+    """
+    Returns list of (staging path, final item path) for everything currently
+    staged in the directory dst.
+    """
+    staged = []
+    for entry in os.scandir(dst):
+        name = _staged_name(entry.name)
+        if name is not None:
+            staged.append((entry.path, join(dst, name)))
+
+    return staged
+
+
+def _is_pending(name):
+    """
+    Whether name is that of a staged copy or copy journal.
+    """
+    return name.startswith('.') and name.endswith(('.staging', '.copy_journal'))
+
+
+class DestinationIndex:
+    """
+    Names of everything directly under a destination directory, from one
+    listing, so checking whether each item is already there doesn't take a
+    round trip to the (NFS) server each time.
+
+    If a shipped_index.ShippedIndex is passed, the names of items it has
+    recorded as shipped to the directory (and of the staged copies and journals
+    it has recorded as pending) are used instead of listing it, and any other
+    item is checked on the destination itself (as it may be an incomplete copy,
+    or just not be recorded).
+
+    Should be kept up to date (via add / discard) as items are copied.
+    """
+    def __init__(self, dst, shipped=None):
+        self.dst = normpath(dst)
+        self.shipped = shipped
+        if shipped is None:
+            with os.scandir(dst) as entries:
+                self.names = {entry.name for entry in entries}
+        else:
+            self.names = shipped.names(self.dst) | shipped.pending_names(
+                self.dst
+            )
+
+        self.n_lookups = 0
+        # Lookups that still had to go to the destination.
+        self.n_stats = 0
+        self._lock = threading.Lock()
+
+
+    def _name(self, path):
+        parent, name = split(path)
+        assert normpath(parent) == self.dst, \
+            f'{path} not directly under {self.dst}'
+        return name
+
+
+    def exists(self, path):
+        name = self._name(path)
+        with self._lock:
+            self.n_lookups += 1
+            if name in self.names:
+                return True
+
+            # Staged copies and journals are all recorded as pending in the
+            # shipped index, so only items it doesn't know need checking.
+            if self.shipped is None or _is_pending(name):
+                return False
+
+            self.n_stats += 1
+
+        return exists(path)
+
+
+    def has_journal(self, dst_item):
+        return self.exists(journal_path(dst_item))
+
+
+    def staged(self):
+        """
+        Like find_staged(self.dst), but without listing the directory again.
+
+        When using a shipped index, only staged copies it has recorded (made by
+        these scripts, or found when reconciling) are known.
+        """
+        with self._lock:
+            names = list(self.names)
+
+        staged = []
+        for staging_name in names:
+            name = _staged_name(staging_name)
+            if name is not None:
+                staged.append((join(self.dst, staging_name),
+                    join(self.dst, name)
+                ))
+
+        return staged
+
+
+    def add(self, path):
+        """
+        Hidden paths (staged copies, journals) are also recorded as pending in
+        the shipped index, if using one, so later runs can find them.
+        """
+        name = self._name(path)
+        with self._lock:
+            self.names.add(name)
+
+        if self.shipped is not None and _is_pending(name):
+            self.shipped.add_pending(path)
+
+
+    def discard(self, path):
+        name = self._name(path)
+        with self._lock:
+            self.names.discard(name)
+
+        if self.shipped is not None and _is_pending(name):
+            self.shipped.discard_pending(path)
+
+
+    def summary(self):
+        if self.shipped is None:
+            return (f'{self.n_lookups} existence checks under {self.dst} '
+                f'answered from 1 listing ({len(self.names)} entries), saving '
+                f'{max(self.n_lookups - 1, 0)} round trips'
+            )
+        else:
+            return (f'{self.n_lookups} existence checks under {self.dst} '
+                f'answered from the shipped index ({len(self.names)} items), '
+                f'with {self.n_stats} round trips'
+            )
+
+
+def copytree_ignore(exclude):
+    """
+    Returns ignore function for copytree, ignoring paths exclude returns True
+    for, or None if exclude is None.
+    """
+    if exclude is None:
+        return None
+
+    return lambda src_dir, names: {name for name in names
+        if exclude(join(src_dir, name))
+    }
+
+
+def copy_tree(src, dst, copy_function, n_workers, exclude=None):
+    """
+    Same result as copytree(src, dst, copy_function=copy_function,
+    dirs_exist_ok=True), but with n_workers threads listing and creating
+    directories (which can each take a round trip to an NFS server) while other
+    threads are copying files (with copy_function).
+
+    Files and directories (under src) that exclude returns True for, if
+    passed, are not copied.
+
+    As with copytree, symlinks are followed, and the stat of each directory is
+    copied after everything in it has been. Raises the first error encountered
+    (once everything that had already started has finished).
+    """
+    lock = threading.Lock()
+    all_done = threading.Condition(lock)
+    errors = []
+    # Number of submitted tasks that have not finished.
+    n_pending = 0
+    # destination dir -> number of its entries not yet (fully) copied
+    n_unfinished = dict()
+    # destination dir -> (source dir, parent destination dir)
+    dir2parent = dict()
+
+    def finish_entry(dst_dir):
+        """
+        Returns list of (source, destination) directories that are now
+        completely copied. Must hold lock.
+        """
+        finished = []
+        while dst_dir is not None:
+            n_unfinished[dst_dir] -= 1
+            if n_unfinished[dst_dir] > 0:
+                break
+
+            del n_unfinished[dst_dir]
+            src_dir, parent = dir2parent.pop(dst_dir)
+            finished.append((src_dir, dst_dir))
+            # The parent directory has one less unfinished entry.
+            dst_dir = parent
+
+        return finished
+
+    def copy_stats(finished):
+        # Copying directory stats only once nothing else will be written under
+        # them, so their mtimes are not changed afterwards.
+        for src_dir, dst_dir in finished:
+            if not errors:
+                copystat(src_dir, dst_dir)
+
+    def run(fn, args, dst_parent):
+        nonlocal n_pending
+        try:
+            if not errors:
+                fn(*args)
+
+            # Directories finish themselves (see copy_dir).
+            if dst_parent is not None:
+                with lock:
+                    finished = finish_entry(dst_parent)
+                copy_stats(finished)
+
+        except BaseException as e:
+            with lock:
+                errors.append(e)
+
+        finally:
+            with lock:
+                n_pending -= 1
+                if n_pending == 0:
+                    all_done.notify_all()
+
+    def submit(fn, args, dst_parent=None):
+        # Must hold lock.
+        nonlocal n_pending
+        n_pending += 1
+        pool.submit(run, fn, args, dst_parent)
+
+    def copy_dir(src_dir, dst_dir, dst_parent):
+        os.makedirs(dst_dir, exist_ok=True)
+        with os.scandir(src_dir) as entries:
+            entries = [e for e in entries
+                if exclude is None or not exclude(e.path)
+            ]
+
+        with lock:
+            # Counting the directory as an unfinished entry of itself until
+            # all of its entries have been submitted, so it can't be finished
+            # (by entries that are done quickly) before then.
+            n_unfinished[dst_dir] = len(entries) + 1
+            dir2parent[dst_dir] = (src_dir, dst_parent)
+            for entry in entries:
+                dst_path = join(dst_dir, entry.name)
+                if entry.is_dir():
+                    submit(copy_dir, (entry.path, dst_path, dst_dir))
+                else:
+                    submit(copy_function, (entry.path, dst_path), dst_dir)
+
+            finished = finish_entry(dst_dir)
+
+        copy_stats(finished)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        with lock:
+            submit(copy_dir, (src, dst, None))
+            while n_pending > 0:
+                all_done.wait()
+
+    if errors:
+        raise errors[0]
+
+
+def _exists(path, dst_index=None):
+    if dst_index is None:
+        return exists(path)
+
+    return dst_index.exists(path)
+
+
+def remove_path(path):
+    if isdir(path) and not os.path.islink(path):
+        rmtree(path)
+    else:
+        os.remove(path)
+
+
+def format_bytes(n_bytes):
+    if n_bytes < 1024:
+        return f'{n_bytes}B'
+
+    for unit in ('KiB', 'MiB', 'GiB', 'TiB'):
+        n_bytes /= 1024
+        if n_bytes < 1024 or unit == 'TiB':
+            return f'{n_bytes:.1f}{unit}'
+
+
+class CopyStats:
+    """
+    Counts of files (and bytes) copied, and skipped because they were already
+    copied, safe to add to from multiple threads.
+    """
+    def __init__(self):
+        self.n_files_copied = 0
+        self.n_bytes_copied = 0
+        self.n_files_skipped = 0
+        self.n_bytes_skipped = 0
+        self._lock = threading.Lock()
+
+
+    def add_copied(self, n_bytes):
+        with self._lock:
+            self.n_files_copied += 1
+            self.n_bytes_copied += n_bytes
+
+
+    def add_skipped(self, n_bytes):
+        with self._lock:
+            self.n_files_skipped += 1
+            self.n_bytes_skipped += n_bytes
+
+
+    def merge(self, other):
+        with self._lock:
+            self.n_files_copied += other.n_files_copied
+            self.n_bytes_copied += other.n_bytes_copied
+            self.n_files_skipped += other.n_files_skipped
+            self.n_bytes_skipped += other.n_bytes_skipped
+
+
+    def summary(self):
+        return (f'{self.n_files_copied} files '
+            f'({format_bytes(self.n_bytes_copied)}) copied, '
+            f'{self.n_files_skipped} files '
+            f'({format_bytes(self.n_bytes_skipped)}) already up to date'
+        )
+
+
+# exFAT only stores mtimes to within 10ms (and FAT32 to within 2s), so copies
+# may not get exactly the same mtime as their source.
+_mtime_tolerance_s = 2.0
+
+
+def is_up_to_date(src_stat, dst):
+    """
+    Whether dst exists and has the same size and (~) mtime as the source.
+    """
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return False
+
+    return (dst_stat.st_size == src_stat.st_size and
+        abs(dst_stat.st_mtime - src_stat.st_mtime) <= _mtime_tolerance_s
+    )
+
+
+def verify_item(src_item, dst_item, rel_paths, options):
+    """
+    Checks the copies of the files at rel_paths (relative to src_item), at the
+    tier in options['verify'], raising IOError on any difference.
+
+    The 'full' tier is done as each file is copied, so that is only logged here.
+    """
+    tier = options['verify']
+    if tier == 'sampled':
+        for rel_path in rel_paths:
+            if rel_path == '.':
+                src, dst = src_item, dst_item
+                difference = sampled_match(src, dst, options)
+            else:
+                src, dst = join(src_item, rel_path), join(dst_item, rel_path)
+                difference = sampled_match(src, dst, options, rel_path)
+
+            if difference is not None:
+                raise IOError(f'{dst} did not match {src} ({difference})')
+
+    elif tier not in ('full', 'none'):
+        raise ValueError(f'unrecognized verify tier {tier}. must be one of '
+            'none, sampled, or full'
+        )
+
+    l.info(f'verified {len(rel_paths)} files copied to {dst_item} '
+        f'(verify tier: {tier})'
+    )
+
+
+def copy_item(src_item, dst_item, options=None, dst_index=None,
+    on_progress=None, exclude=None):
+    """
+    Copies a file or directory, resuming an earlier interrupted copy (according
+    to its journal) when options['journal'] is set.
+
+    If options['staging'] is set, the copy is made under staging_path(dst_item),
+    and only renamed to dst_item once finished.
+
+    If options['sync'] is set and dst_item already exists, only files that are
+    missing at the destination, or differ in size or mtime, are copied.
+
+    If hashing (see hash_algorithm), files are hashed as they are copied, and
+    the hashes written to manifest_path(dst_item, <algorithm>).
+
+    If a DestinationIndex for the directory containing dst_item is passed, it
+    is used to check what is already there, and updated after the copy.
+
+    on_progress is passed to copy_file (and called with the bytes written by
+    delta copies).
+
+    If src_item is a directory, anything under it that exclude (a function of
+    the source path, if passed) returns True for is not copied.
+
+    Returns a CopyStats for this item.
+    """
+    if options is None:
+        options = default_copy_options
+
+    before_copy = time.time()
+
+    journal = None
+    if options['journal']:
+        jpath = journal_path(dst_item)
+        journal = CopyJournal(jpath, resuming=None if dst_index is None else
+            dst_index.exists(jpath)
+        )
+        if journal.resuming:
+            l.info(f'resuming copy of {src_item} ({len(journal.done)} files '
+                'already done)'
+            )
+        elif dst_index is not None:
+            dst_index.add(jpath)
+
+    dst_item_existed = _exists(dst_item, dst_index)
+    syncing = options['sync'] and dst_item_existed
+    if syncing:
+        l.info(f'{dst_item} already existed. only copying changed files.')
+
+    elif journal is None or not journal.resuming:
+        assert not dst_item_existed, f'{dst_item} existed before copy'
+
+    # dst_item can only exist here if we are resuming a copy that was made
+    # without staging, or syncing, in which case we just copy in place.
+    stage = options['staging'] and not dst_item_existed
+    if stage:
+        copy_dst = staging_path(dst_item)
+        if (_exists(copy_dst, dst_index) and
+            (journal is None or not journal.resuming)):
+
+            l.info(f'removing {copy_dst} left by earlier incomplete copy, '
+                'which could not be resumed'
+            )
+            remove_path(copy_dst)
+
+        if dst_index is not None:
+            dst_index.add(copy_dst)
+    else:
+        copy_dst = dst_item
+
+    shipped = None if dst_index is None else dst_index.shipped
+
+    algorithm = hash_algorithm(options)
+    # relative path (from src_item) -> hex digest (None if not yet known)
+    digests = dict()
+    copied_rel_paths = []
+    # relative path -> source stat, for every file copied or already up to date
+    rel_path2stat = dict()
+
+    backends_used = set()
+    stats = CopyStats()
+    def copy_function(src, dst):
+        src_stat = os.stat(src)
+        rel_path = relpath(src, src_item)
+        rel_path2stat[rel_path] = src_stat
+        if syncing:
+            shipped_state = None if shipped is None else shipped.file_state(dst)
+            # Not checking the destination itself, if we know what we put there.
+            if shipped_state is not None:
+                size, mtime = shipped_state
+                up_to_date = (size == src_stat.st_size and
+                    abs(mtime - src_stat.st_mtime) <= _mtime_tolerance_s
+                )
+            else:
+                up_to_date = is_up_to_date(src_stat, dst)
+
+            if up_to_date:
+                stats.add_skipped(src_stat.st_size)
+                digests[rel_path] = None
+                return
+
+        if journal is not None:
+            if journal.is_done(rel_path, src_stat, dst):
+                stats.add_skipped(src_stat.st_size)
+                digests[rel_path] = journal.digests.get(rel_path)
+                return
+
+            journal.record(rel_path, src_stat, False)
+
+        hasher = None
+        if algorithm is not None:
+            hasher = hashlib.new(algorithm)
+
+        delta_threshold = options['delta_threshold_mb'] * 1024**2
+        if (syncing and options['delta'] and
+            src_stat.st_size >= delta_threshold and isfile(dst)):
+
+            _, n_bytes_written = delta_copy_file(src, dst, options=options)
+            backends_used.add('delta')
+            if on_progress is not None:
+                on_progress(n_bytes_written)
+            # Only part of the data passed through, so hashing separately.
+            digest = None if algorithm is None else hash_file(src, algorithm)
+        else:
+            backend = copy_file(src, dst, options=options, hasher=hasher,
+                on_progress=on_progress
+            )
+            if backend is not None:
+                backends_used.add(backend)
+
+            n_bytes_written = src_stat.st_size
+            digest = None if hasher is None else hasher.hexdigest()
+
+        if options['verify'] == 'full':
+            dst_digest = hash_file(dst, algorithm)
+            if dst_digest != digest:
+                raise IOError(f'{dst} {algorithm} hash ({dst_digest}) did not '
+                    f'match that of {src} ({digest})'
+                )
+
+        digests[rel_path] = digest
+        copied_rel_paths.append(rel_path)
+        stats.add_copied(n_bytes_written)
+
+        if journal is not None:
+            journal.record(rel_path, src_stat, True, digest=digest)
+
+    try:
+        if isdir(src_item) and options['tree_workers'] > 1:
+            copy_tree(src_item, copy_dst, copy_function,
+                options['tree_workers'], exclude=exclude
+            )
+        elif isdir(src_item):
+            copytree(src_item, copy_dst, copy_function=copy_function,
+                ignore=copytree_ignore(exclude), dirs_exist_ok=True
+            )
+        else:
+            # Assuming it was a file here.
+            copy_function(src_item, copy_dst)
+
+        if algorithm is not None:
+            write_item_manifest(src_item, dst_item, algorithm, digests)
+
+    except:
+        # Keeping the journal, so the copy can be resumed.
+        if journal is not None:
+            journal.close()
+        raise
+
+    # Deleting the journal before renaming, so that if we are interrupted in
+    # between, the leftover staged copy is just recopied rather than resumed.
+    if journal is not None:
+        journal.close(delete=True)
+
+    if stats.n_files_skipped > 0:
+        l.info(f'{src_item}: {stats.summary()}')
+
+    if stage:
+        os.rename(copy_dst, dst_item)
+
+    if dst_index is not None:
+        dst_index.discard(journal_path(dst_item))
+        dst_index.discard(copy_dst)
+        dst_index.add(dst_item)
+
+    if shipped is not None:
+        files = []
+        for rel_path, src_stat in rel_path2stat.items():
+            path = dst_item if rel_path == '.' else join(dst_item, rel_path)
+            files.append((path, src_stat.st_size, src_stat.st_mtime,
+                digests.get(rel_path)
+            ))
+        shipped.record_item(dst_item, files)
+
+    copy_duration_s = time.time() - before_copy
+    backends_str = ', '.join(sorted(backends_used)) or 'none'
+    l.info(f'copying {src_item} took {copy_duration_s:.2f}s (copy backends: '
+        f'{backends_str})'
+    )
+    # If staging, the rename would have failed otherwise.
+    if not stage:
+        assert exists(dst_item), f'{dst_item} did not exist after copy'
+
+    verify_item(src_item, dst_item, copied_rel_paths, options)
+
+    return stats
+
+
+def plan_item(src_item, dst_item, options=None, dst_index=None,
+    exclude=None):
+    """
+    Returns a CopyStats with the files (and bytes) copy_item would copy, and
+    those it would skip, without copying anything.
+    """
+    if options is None:
+        options = default_copy_options
+
+    done = dict()
+    jpath = journal_path(dst_item)
+    if options['journal'] and _exists(jpath, dst_index):
+        done, _ = read_journal(jpath)
+    resuming = len(done) > 0
+
+    dst_item_existed = _exists(dst_item, dst_index)
+    syncing = options['sync'] and dst_item_existed
+    copy_dst = dst_item
+    if options['staging'] and not dst_item_existed:
+        copy_dst = staging_path(dst_item)
+        # copy_item would remove this first.
+        if not resuming:
+            copy_dst = None
+
+    def plan_file(src, dst, rel_path):
+        src_stat = os.stat(src)
+        # Same checks as copy_item makes.
+        if copy_dst is not None:
+            if syncing and is_up_to_date(src_stat, dst):
+                stats.add_skipped(src_stat.st_size)
+                return
+
+            if done.get(rel_path) == (src_stat.st_size, src_stat.st_mtime):
+                try:
+                    if os.stat(dst).st_size == src_stat.st_size:
+                        stats.add_skipped(src_stat.st_size)
+                        return
+                except FileNotFoundError:
+                    pass
+
+        stats.add_copied(src_stat.st_size)
+
+    stats = CopyStats()
+    if isdir(src_item):
+        for dirpath, dirnames, filenames in os.walk(src_item,
+            followlinks=True):
+
+            if exclude is not None:
+                dirnames[:] = [d for d in dirnames
+                    if not exclude(join(dirpath, d))
+                ]
+
+            for filename in filenames:
+                src = join(dirpath, filename)
+                if exclude is not None and exclude(src):
+                    continue
+
+                rel_path = relpath(src, src_item)
+                plan_file(src, None if copy_dst is None else
+                    join(copy_dst, rel_path), rel_path
+                )
+    else:
+        plan_file(src_item, copy_dst, relpath(src_item, src_item))
+
+    return stats
+
+
+class Prefetcher:
+    """
+    Iterates over iterable in a background thread, staying at most maxsize
+    elements ahead of whatever is iterating over this.
+
+    n_produced is the number of elements produced so far, so that consumers can
+    refine their idea of the total as it gets closer. Exceptions raised by
+    iterable are re-raised when the element they interrupted would have been
+    consumed.
+    """
+    _end = object()
+
+    def __init__(self, iterable, maxsize=64):
+        self.n_produced = 0
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._produce,
+            args=(iterable,), daemon=True
+        )
+        self._thread.start()
+
+
+    def _put(self, x):
+        # Not blocking indefinitely, so close() can stop this thread even if
+        # nothing else will be consumed.
+        while not self._closed.is_set():
+            try:
+                self._queue.put(x, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+
+    def _produce(self, iterable):
+        try:
+            for x in iterable:
+                if not self._put(x):
+                    return
+
+                self.n_produced += 1
+
+        except BaseException as e:
+            self._put(e)
+            return
+
+        self._put(self._end)
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        if self._closed.is_set():
+            raise StopIteration
+
+        x = self._queue.get()
+        if x is self._end:
+            self.close()
+            raise StopIteration
+
+        if isinstance(x, BaseException):
+            self.close()
+            raise x
+
+        return x
+
+
+    def close(self):
+        self._closed.set()
+
+
+_no_space_errnos = {errno.ENOSPC, errno.EDQUOT}
+
+
+class ConcurrencyController:
+    """
+    Chooses how many copies (between options['min_workers'] and
+    options['max_workers']) should run at once, with an additive increase /
+    multiplicative decrease policy on the total throughput of those copies.
+
+    Bytes copied are reported (from any thread) with add_bytes, and update is
+    called with the number of copies running, returning how many there should
+    be. Throughput is only compared between windows (of
+    options['adaptive_window_s']) where all the workers were kept busy, each
+    starting after the last adjustment.
+    """
+    def __init__(self, name, options=None):
+        if options is None:
+            options = default_copy_options
+
+        self.name = name
+        self.min_workers = options['min_workers']
+        self.max_workers = max(options['max_workers'], self.min_workers)
+        self.n_workers = min(max(options['n_workers'], self.min_workers),
+            self.max_workers
+        )
+        self.window_s = options['adaptive_window_s']
+        self.decrease_factor = options['adaptive_decrease_factor']
+        self.tolerance = options['adaptive_tolerance']
+
+        self._lock = threading.Lock()
+        self._window_start = time.time()
+        self._window_bytes = 0
+        # Whether all workers were busy for the whole window so far.
+        self._saturated = True
+        # Of the last window where workers were all busy.
+        self._last_bytes_per_s = None
+        # number of workers -> list of throughputs (bytes per second) measured
+        # with that many.
+        self._n_workers2rates = dict()
+
+
+    def add_bytes(self, n_bytes):
+        with self._lock:
+            self._window_bytes += n_bytes
+
+
+    def update(self, n_running):
+        """
+        Returns how many copies should be running, adjusted if a window just
+        ended, given n_running were running since the last call.
+        """
+        now = time.time()
+        with self._lock:
+            if n_running < self.n_workers:
+                self._saturated = False
+
+            window_s = now - self._window_start
+            if window_s < self.window_s:
+                return self.n_workers
+
+            bytes_per_s = self._window_bytes / window_s
+            saturated = self._saturated
+            self._window_start = now
+            self._window_bytes = 0
+            self._saturated = True
+
+        # More workers can't help if there weren't enough items to keep those
+        # we had busy, and the throughput is not comparable.
+        if not saturated:
+            self._last_bytes_per_s = None
+            return self.n_workers
+
+        self._n_workers2rates.setdefault(self.n_workers, []).append(
+            bytes_per_s
+        )
+        n_workers = self.n_workers
+        if (self._last_bytes_per_s is not None and
+            bytes_per_s < self._last_bytes_per_s * (1 - self.tolerance)):
+
+            n_workers = max(int(n_workers * self.decrease_factor),
+                self.min_workers
+            )
+            reason = 'dropped from'
+        else:
+            n_workers = min(n_workers + 1, self.max_workers)
+            reason = 'held up compared to'
+
+        if n_workers != self.n_workers:
+            last = '(nothing to compare to)'
+            if self._last_bytes_per_s is not None:
+                last = f'{reason} {format_bytes(self._last_bytes_per_s)}/s'
+
+            l.info(f'{self.name}: {format_bytes(bytes_per_s)}/s with '
+                f'{self.n_workers} workers {last}. changing to {n_workers} '
+                'workers.'
+            )
+            # Fewer workers are expected to be slower than those before, so
+            # not comparing with them.
+            decreased = n_workers < self.n_workers
+            self.n_workers = n_workers
+            if decreased:
+                bytes_per_s = None
+
+        self._last_bytes_per_s = bytes_per_s
+        return self.n_workers
+
+
+    def summary(self):
+        """
+        Returns str with the mean throughput measured with each number of
+        workers tried, and the number that was best.
+        """
+        if len(self._n_workers2rates) == 0:
+            return (f'{self.name}: no full windows measured (ended with '
+                f'{self.n_workers} workers)'
+            )
+
+        n_workers2mean = {n: sum(rates) / len(rates)
+            for n, rates in sorted(self._n_workers2rates.items())
+        }
+        best = max(n_workers2mean, key=n_workers2mean.get)
+        means = ', '.join(f'{n}: {format_bytes(mean)}/s'
+            for n, mean in n_workers2mean.items()
+        )
+        return (f'{self.name}: best throughput with {best} workers (mean '
+            f'throughput by number of workers: {means})'
+        )
+
+
+class RateLimiter:
+    """
+    Token bucket capping the total rate that copies sharing it write data at to
+    bytes_per_s, allowing bursts of up to burst_s seconds worth. Each copy
+    reports what it wrote with consume, which sleeps as long as it takes for
+    the bucket to cover that.
+
+    If is_limited is passed, the cap only applies while is_limited() returns
+    True (e.g. during working hours). Either way, the rate actually achieved
+    over the last window_s seconds is available from rate.
+    """
+    def __init__(self, bytes_per_s, is_limited=None, burst_s=1.0,
+        window_s=5.0):
+
+        assert bytes_per_s > 0
+        self.bytes_per_s = bytes_per_s
+        self.is_limited = is_limited
+        self.capacity = bytes_per_s * burst_s
+        self.window_s = window_s
+
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._last_time = time.monotonic()
+        self._start_time = self._last_time
+        # (time, number of bytes) of each consume within the last window_s.
+        self._recent = deque()
+        self._recent_bytes = 0
+
+
+    @property
+    def limited(self):
+        return self.is_limited is None or self.is_limited()
+
+
+    def consume(self, n_bytes):
+        limited = self.limited
+        with self._lock:
+            now = time.monotonic()
+            self._recent.append((now, n_bytes))
+            self._recent_bytes += n_bytes
+
+            if not limited:
+                self._tokens = self.capacity
+                self._last_time = now
+                return
+
+            self._tokens = min(self.capacity,
+                self._tokens + (now - self._last_time) * self.bytes_per_s
+            )
+            self._last_time = now
+            # Copies that arrive while others are waiting go further into
+            # debt, and so wait longer, which keeps the total rate capped.
+            self._tokens -= n_bytes
+            wait_s = max(-self._tokens / self.bytes_per_s, 0)
+
+        if wait_s > 0:
+            time.sleep(wait_s)
+
+
+    def rate(self):
+        """
+        Returns bytes per second written over the last window_s seconds.
+        """
+        with self._lock:
+            now = time.monotonic()
+            while (len(self._recent) > 0 and
+                now - self._recent[0][0] > self.window_s):
+
+                self._recent_bytes -= self._recent.popleft()[1]
+
+            return self._recent_bytes / max(
+                min(now - self._start_time, self.window_s), 1e-3
+            )
+
+
+    def summary(self):
+        """
+        Returns str with the rate data is being written at, and the cap.
+        """
+        cap = format_bytes(self.bytes_per_s)
+        if self.limited:
+            cap = f'limited to {cap}/s'
+        else:
+            cap = f'{cap}/s limit lifted by schedule'
+        return f'{format_bytes(self.rate())}/s ({cap})'
+
+
+def is_no_space_error(e):
+    """
+    Whether e was from the destination running out of space (or quota).
+    """
+    if isinstance(e, shutil.Error):
+        # copytree collects errors from copying each file as strings.
+        reasons = [os.strerror(n) for n in _no_space_errnos]
+        return any(any(reason in str(why) for reason in reasons)
+            for _, _, why in e.args[0]
+        )
+
+    return isinstance(e, OSError) and e.errno in _no_space_errnos
+
+
+def _prepare_retry(dst_item, options, dst_index):
+    """
+    Gets dst_item ready to be copied again, after a copy to it failed.
+    """
+    if dst_index is not None:
+        # So the retry resumes from what the failed copy left.
+        for path in (journal_path(dst_item), staging_path(dst_item)):
+            if exists(path):
+                dst_index.add(path)
+
+    # Nothing to resume from, so the partial copy would just be in the way.
+    if (not options['journal'] and not options['staging'] and
+        not options['sync'] and exists(dst_item)):
+
+        remove_path(dst_item)
+        if dst_index is not None:
+            dst_index.discard(dst_item)
+
+
+def copy_items(item_pairs, options=None, on_start=None, stats=None,
+    dst_index=None, on_no_space=None, controller=None, rate_limiter=None,
+    exclude=None):
+    """
+    Copies each (src_item, dst_item) in item_pairs, with up to
+    options['n_workers'] copies in progress at once, or as many as controller
+    (a ConcurrencyController, if passed) decides. Counts for each successful
+    copy are added to stats, if passed. dst_index and exclude are passed to
+    copy_item.
+
+    If a RateLimiter is passed, copies wait (between chunks) as long as it
+    takes to stay under its rate.
+
+    Yields (src_item, dst_item, exception) as each copy finishes, with exception
+    None if the copy was successful. Items are only started as earlier ones
+    finish, and on_start(src_item, dst_item) is called (from the calling thread,
+    so it is safe to update the GUI there) just before each is started.
+
+    If copies fail because the destination is out of space, and on_no_space is
+    passed, on_no_space(dst_items, exception) is called (from the calling
+    thread, with nothing new started until it returns) instead of yielding the
+    errors. If it returns True, those items are copied again (resuming where
+    they left off, when journaling), and otherwise the errors are yielded.
+    """
+    if options is None:
+        options = default_copy_options
+
+    n_workers = options['n_workers']
+    max_workers = n_workers
+    # So the number of workers is still updated when no copy finishes within a
+    # window.
+    timeout_s = None
+    if controller is not None:
+        n_workers = controller.n_workers
+        max_workers = controller.max_workers
+        timeout_s = controller.window_s / 2
+
+    on_progress = None
+    if controller is not None or rate_limiter is not None:
+        def on_progress(n_bytes):
+            if controller is not None:
+                controller.add_bytes(n_bytes)
+            if rate_limiter is not None:
+                rate_limiter.consume(n_bytes)
+
+    item_pairs = iter(item_pairs)
+    retries = []
+    in_flight = dict()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        try:
+            while True:
+                while len(in_flight) < n_workers:
+                    if len(retries) > 0:
+                        pair = retries.pop(0)
+                    else:
+                        pair = next(item_pairs, None)
+
+                    if pair is None:
+                        break
+
+                    if on_start is not None:
+                        on_start(*pair)
+
+                    in_flight[pool.submit(copy_item, *pair, options,
+                        dst_index, on_progress, exclude)] = pair
+
+                if len(in_flight) == 0:
+                    break
+
+                if controller is not None:
+                    n_workers = controller.update(len(in_flight))
+
+                done, _ = wait(in_flight, timeout=timeout_s,
+                    return_when=FIRST_COMPLETED
+                )
+                no_space = []
+                for future in done:
+                    src_item, dst_item = in_flight.pop(future)
+                    e = future.exception()
+                    if e is None and stats is not None:
+                        stats.merge(future.result())
+
+                    if (e is not None and on_no_space is not None and
+                        is_no_space_error(e)):
+                        no_space.append((src_item, dst_item, e))
+                        continue
+
+                    yield src_item, dst_item, e
+
+                if len(no_space) > 0:
+                    l.error(f'out of space copying '
+                        f'{[dst for _, dst, _ in no_space]}. pausing.'
+                    )
+                    if on_no_space([dst for _, dst, _ in no_space],
+                        no_space[0][2]):
+
+                        l.info('retrying copies that ran out of space')
+                        for src_item, dst_item, _ in no_space:
+                            _prepare_retry(dst_item, options, dst_index)
+                            retries.append((src_item, dst_item))
+                    else:
+                        yield from no_space
+
+        # So nothing new is started if the caller stops early (e.g. on error).
+        # Copies already running will still finish before the pool shuts down.
+        finally:
+            for future in in_flight:
+                future.cancel()
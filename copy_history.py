@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent (SQLite) record of how long copying each rule took, so durations of
+future copies between the same source and destination can be predicted, and of
+items deferred by a time budget (see TimeBudget), to copy first next time.
+"""
+
+import logging
+from os.path import join, split, normpath
+import sqlite3
+import threading
+import time
+
+
+l = logging.getLogger(__name__)
+
+default_history_file = join(split(__file__)[0], 'copy_history.sqlite')
+
+
+class CopyHistory:
+    def __init__(self, path=default_history_file):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.executescript('''
+                CREATE TABLE IF NOT EXISTS runs (
+                    src TEXT NOT NULL,
+                    dst TEXT NOT NULL,
+                    finished_at REAL NOT NULL,
+                    n_files INTEGER NOT NULL,
+                    n_bytes INTEGER NOT NULL,
+                    duration_s REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS deferred (
+                    src_item TEXT PRIMARY KEY,
+                    dst_item TEXT NOT NULL,
+                    src TEXT NOT NULL,
+                    dst TEXT NOT NULL,
+                    n_bytes INTEGER,
+                    deferred_at REAL NOT NULL
+                );
+            ''')
+
+
+    def record(self, src, dst, n_files, n_bytes, duration_s):
+        """
+        Records that copying n_files (n_bytes total) from src to dst took
+        duration_s seconds. Runs that copied no bytes (only empty files) are
+        not recorded, as they say nothing about throughput.
+        """
+        if n_bytes == 0:
+            return
+
+        with self._lock, self._conn:
+            self._conn.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?)',
+                (normpath(src), normpath(dst), time.time(), n_files, n_bytes,
+                duration_s
+                )
+            )
+
+
+    def throughput(self, src, dst, n_recent=10):
+        """
+        Returns (bytes per second, number of runs it is from) over the last
+        n_recent runs copying from src to dst, falling back to runs from any
+        source to dst. Returns None if there are no such runs.
+        """
+        queries = [
+            ('src = ? AND dst = ?', (normpath(src), normpath(dst))),
+            ('dst = ?', (normpath(dst),))
+        ]
+        for where, args in queries:
+            with self._lock:
+                rows = self._conn.execute(
+                    f'SELECT n_bytes, duration_s FROM runs WHERE {where} '
+                    'ORDER BY finished_at DESC LIMIT ?', args + (n_recent,)
+                ).fetchall()
+
+            total_s = sum(duration_s for _, duration_s in rows)
+            total_bytes = sum(n_bytes for n_bytes, _ in rows)
+            # Histories from before 0 byte runs were skipped can have only
+            # those.
+            if total_s > 0 and total_bytes > 0:
+                return total_bytes / total_s, len(rows)
+
+        return None
+
+
+    def deferred(self, src, dst):
+        """
+        Returns set of source items (under src) deferred when copying to dst.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT src_item FROM deferred WHERE src = ? AND dst = ?',
+                (normpath(src), normpath(dst))
+            ).fetchall()
+
+        return {src_item for src_item, in rows}
+
+
+    def set_deferred(self, src, dst, deferred):
+        """
+        Replaces items recorded as deferred from src to dst with deferred, a
+        list of (src_item, dst_item, n_bytes) (n_bytes may be None).
+        """
+        src = normpath(src)
+        dst = normpath(dst)
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'DELETE FROM deferred WHERE src = ? AND dst = ?', (src, dst)
+            )
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO deferred VALUES (?, ?, ?, ?, ?, ?)',
+                [(src_item, dst_item, src, dst, n_bytes, now)
+                    for src_item, dst_item, n_bytes in deferred
+                ]
+            )
+
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class TimeBudget:
+    """
+    Decides which items can start copying, so that everything started is
+    predicted to finish within budget_s seconds of this being created.
+
+    Predictions use the throughput (over all copies at once) measured so far
+    in this run, or before any copies have finished, the throughput in the
+    history for the source / destination pair. Without either, items are
+    started regardless of the budget. Can be shared by rules copying at the
+    same time.
+    """
+    def __init__(self, budget_s, history=None):
+        self.budget_s = budget_s
+        self.history = history
+        self.start_time = time.time()
+        # Of items started and not yet finished.
+        self.n_bytes_in_flight = 0
+        self.n_bytes_done = 0
+        # When the first copy started.
+        self._copy_start_time = None
+        # Time since then that copying was paused (not counted in throughput).
+        self._paused_s = 0.0
+        # (src_item, dst_item, n_bytes) of items not started because they
+        # would not have fit.
+        self.deferred = []
+        self._lock = threading.Lock()
+
+
+    @property
+    def time_left_s(self):
+        return self.budget_s - (time.time() - self.start_time)
+
+
+    def bytes_per_s(self, src, dst):
+        """
+        Returns estimated throughput in bytes per second, or None if unknown.
+        """
+        if self.n_bytes_done > 0:
+            return self.n_bytes_done / max(
+                time.time() - self._copy_start_time - self._paused_s, 1e-3
+            )
+
+        if self.history is not None:
+            throughput = self.history.throughput(src, dst)
+            if throughput is not None:
+                return throughput[0]
+
+        return None
+
+
+    def fits(self, src, dst, n_bytes):
+        """
+        Whether copying n_bytes (on top of copies already in progress) is
+        predicted to finish within the budget. Can be None if the size is not
+        known, in which case the item only fits if there is still time left.
+        """
+        time_left_s = self.time_left_s
+        if time_left_s <= 0:
+            return False
+
+        bytes_per_s = self.bytes_per_s(src, dst)
+        # No (useful) estimate, e.g. if only empty files were copied so far.
+        if bytes_per_s is None or bytes_per_s <= 0 or n_bytes is None:
+            return True
+
+        return (self.n_bytes_in_flight + n_bytes) / bytes_per_s <= time_left_s
+
+
+    def started(self, n_bytes):
+        with self._lock:
+            if self._copy_start_time is None:
+                self._copy_start_time = time.time()
+
+            self.n_bytes_in_flight += n_bytes or 0
+
+
+    def finished(self, n_bytes):
+        with self._lock:
+            self.n_bytes_in_flight -= n_bytes or 0
+            self.n_bytes_done += n_bytes or 0
+
+
+    def paused(self, duration_s):
+        """
+        Records that copying was paused (e.g. waiting for space to be freed) for
+        duration_s, so that doesn't lower the measured throughput.
+        """
+        with self._lock:
+            if self._copy_start_time is not None:
+                self._paused_s += duration_s
+
+
+    def select(self, src, dst, item_sizes, deferred=None):
+        """
+        Yields (src_item, dst_item) for each (src_item, dst_item, n_bytes) in
+        item_sizes that fits, adding those that don't to deferred (and to the
+        list passed as deferred, if any, e.g. to collect those of one rule).
+        Items have to be reported as started / finished for the estimates to be
+        right.
+        """
+        for src_item, dst_item, n_bytes in item_sizes:
+            if not self.fits(src, dst, n_bytes):
+                l.info(f'deferring {src_item} ({n_bytes} bytes), which would '
+                    f'not finish in the {max(self.time_left_s, 0):.0f}s left '
+                    'of the time budget'
+                )
+                self.deferred.append((src_item, dst_item, n_bytes))
+                if deferred is not None:
+                    deferred.append((src_item, dst_item, n_bytes))
+                continue
+
+            yield src_item, dst_item
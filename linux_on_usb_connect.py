@@ -1,17 +1,24 @@
 #!/usr/bin/env python3
 
+import argparse
+from datetime import datetime
 import getpass
+import json
 import os
-from os.path import split, join, exists, isdir, expanduser
-import glob
-from shutil import copy2, copytree
+from os.path import split, join, isdir, expanduser
 import traceback
 import time
 from subprocess import Popen, CalledProcessError
 
+import pytimeparse
 import yaml
 
 import util
+import copy_engine
+import shipped_index
+import copy_history
+import source_scan
+import rule_scheduler
 
 
 # systemctl should log this print
@@ -67,6 +74,493 @@ def load_config():
     return config
 
 
+def get_shipped_index(config):
+    """
+    Returns a shipped_index.ShippedIndex if the config enables one, else None.
+    """
+    # Either True (to use the default index file) or the path to one.
+    index_file = config.get('shipped_index', False)
+    if not index_file:
+        return None
+
+    if index_file is True:
+        index_file = shipped_index.default_index_file
+
+    info(f'using shipped index at {index_file}')
+    return shipped_index.ShippedIndex(index_file)
+
+
+def reconcile():
+    """
+    Updates the shipped index to match the contents of each rule destination.
+    """
+    config = load_config()
+    shipped = get_shipped_index(config)
+    if shipped is None:
+        error('shipped_index not enabled in config. nothing to reconcile.')
+        return
+
+    for rule in config['copy_rules']:
+        dst = rule['to']
+        if not isdir(dst):
+            error(f'rule destination {dst} was not an existing directory')
+            continue
+
+        shipped.reconcile(dst)
+
+    shipped.close()
+
+
+def get_max_age_s(config, rule):
+    """
+    Returns max age (in seconds) of items to copy under rule, or None to copy
+    items of any age.
+    """
+    # e.g. '4 weeks'. Can be set for all rules, or overridden within one.
+    max_age = rule.get('ignore_files_older_than',
+        config.get('ignore_files_older_than')
+    )
+    if max_age is None:
+        return None
+
+    max_age_s = pytimeparse.parse(max_age)
+    if max_age_s is None:
+        raise ValueError('could not parse ignore_files_older_than value '
+            f'{max_age}'
+        )
+    return max_age_s
+
+
+def get_order(config, rule):
+    """
+    Returns order to copy items under rule in (see source_scan.order_items), or
+    None to copy them in the order they are found.
+    """
+    return rule.get('order', config.get('order'))
+
+
+def prioritized_rules(config, history=None):
+    """
+    Returns list of (rule number, rule), highest 'priority' (default 0) first,
+    and otherwise in config order. If a copy_history.CopyHistory is passed,
+    rules with items deferred (by a time budget) last time go first.
+    """
+    def has_deferred(rule):
+        return history is not None and len(history.deferred(
+            join(root, rule['from']), rule['to'])
+        ) > 0
+
+    rules = list(enumerate(config['copy_rules']))
+    return sorted(rules, key=lambda x:
+        (not has_deferred(x[1]), -x[1].get('priority', 0))
+    )
+
+
+def get_time_budget_s(config):
+    """
+    Returns time (in seconds) all rules should finish copying within, or None
+    if there is no limit.
+    """
+    # e.g. '20 minutes'
+    time_budget = config.get('time_budget')
+    if time_budget is None:
+        return None
+
+    time_budget_s = pytimeparse.parse(time_budget)
+    if time_budget_s is None:
+        raise ValueError(f'could not parse time_budget value {time_budget}')
+    return time_budget_s
+
+
+def get_mtime_cache(config):
+    """
+    Returns a source_scan.NewestMtimeCache if any rules have a max age or are
+    ordered by something other than name, else None.
+    """
+    if all(get_max_age_s(config, rule) is None and
+        not source_scan.needs_item_stats(get_order(config, rule))
+        for rule in config['copy_rules']):
+        return None
+
+    return source_scan.NewestMtimeCache(config.get('newest_mtime_cache',
+        source_scan.default_mtime_cache_file
+    ))
+
+
+def get_copy_history(config):
+    return copy_history.CopyHistory(config.get('copy_history',
+        copy_history.default_history_file
+    ))
+
+
+def get_rule_scheduler(config):
+    """
+    Returns rule_scheduler.RuleScheduler with the limits on how many rules can
+    read from / write to each device at once.
+    """
+    return rule_scheduler.RuleScheduler(
+        config.get('max_rules_per_source_device', 1),
+        config.get('max_rules_per_destination_device', 1)
+    )
+
+
+weekdays = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+
+def parse_days(days):
+    """
+    Returns set of weekday numbers (Monday 0) from e.g. 'mon-fri', 'sat,sun',
+    or a list of those.
+    """
+    if isinstance(days, str):
+        days = days.split(',')
+
+    day_numbers = set()
+    for part in days:
+        first, _, last = part.strip().lower().partition('-')
+        if first not in weekdays or (last and last not in weekdays):
+            raise ValueError(f'unrecognized days {part}. should be like '
+                'mon-fri or sat,sun'
+            )
+        first = weekdays.index(first)
+        last = weekdays.index(last) if last else first
+        day_numbers.update(d % 7 for d in range(first, first +
+            (last - first) % 7 + 1
+        ))
+
+    return day_numbers
+
+
+def parse_time_of_day(time_of_day):
+    """
+    Returns minutes since midnight from e.g. '08:30'.
+    """
+    # YAML reads unquoted 08:30 as a (base 60) number, which is the same thing.
+    if isinstance(time_of_day, int):
+        return time_of_day
+
+    hours, _, minutes = str(time_of_day).partition(':')
+    return int(hours) * 60 + int(minutes or 0)
+
+
+def in_time_window(window, when):
+    """
+    Whether datetime when is within window, a dict with 'from' and 'to' times
+    of day (where 'to' can be earlier than 'from', to go past midnight), and
+    optionally 'days' it starts on (see parse_days. Default every day).
+    """
+    days = parse_days(window.get('days', 'mon-sun'))
+    start = parse_time_of_day(window['from'])
+    end = parse_time_of_day(window['to'])
+    minute = when.hour * 60 + when.minute
+    day = when.weekday()
+    if start <= end:
+        return day in days and start <= minute < end
+
+    return ((day in days and minute >= start) or
+        ((day - 1) % 7 in days and minute < end)
+    )
+
+
+def get_rate_limiter(config):
+    """
+    Returns a copy_engine.RateLimiter (shared by all rules, as they all read
+    from this drive) for the config's bandwidth_limit_mb_s, only applied during
+    its bandwidth_limit_schedule (if any). None if there is no limit.
+    """
+    limit_mb_s = config.get('bandwidth_limit_mb_s')
+    if limit_mb_s is None:
+        return None
+
+    schedule = config.get('bandwidth_limit_schedule')
+    is_limited = None
+    if schedule is not None:
+        # Checking these parse now, rather than once copying.
+        for window in schedule:
+            in_time_window(window, datetime.now())
+
+        def is_limited():
+            now = datetime.now()
+            return any(in_time_window(w, now) for w in schedule)
+
+    info(f'limiting copies to {limit_mb_s}MiB/s' + ('' if schedule is None
+        else f' during {schedule}'
+    ))
+    return copy_engine.RateLimiter(limit_mb_s * 1024**2, is_limited)
+
+
+def get_source_walks(config):
+    """
+    Returns dict of rule source -> source_scan.SourceWalk, where all rules
+    reading from the same source directory share one walk of it.
+    """
+    src2walk = dict()
+    for rn, rule in enumerate(config['copy_rules']):
+        src = join(root, rule['from'])
+        if src not in src2walk:
+            src2walk[src] = source_scan.SourceWalk(src)
+
+        src2walk[src].add_rule(rn, source_scan.rule_selector(rule))
+
+    return src2walk
+
+
+def rule_item_pairs(rn, walk, dst, dst_index, copy_options, max_age_s,
+    order, mtime_cache, current_time_s, first=()):
+    """
+    Yields (src_item, dst_item) for each item rule rn should copy.
+
+    Unless syncing, only items that do not already exist at the destination (or
+    were only partially copied there) are copied.
+
+    Items are yielded as they are found, unless an order is passed, in which
+    case the whole source has to be scanned before the first is yielded. The
+    same goes if any source items are in first, which are yielded before the
+    others.
+    """
+    def too_old(entry):
+        if max_age_s is None:
+            return False
+
+        # Using the newest mtime of anything in the item, since the mtime of a
+        # directory doesn't change when files deeper in it do.
+        age_s = current_time_s - mtime_cache.newest_mtime(entry)
+        if age_s > max_age_s:
+            info(f'skipping {entry.path} because it was too old '
+                f'({age_s:.0f} > {max_age_s:.0f} seconds)'
+            )
+            return True
+
+        return False
+
+    # Items selected from different subdirectories (with **) can have the same
+    # name.
+    names = set()
+    entries = walk.items(rn)
+    if order is not None:
+        entries = source_scan.order_items(entries, order, mtime_cache)
+
+    if len(first) > 0:
+        entries = list(entries)
+        entries = ([e for e in entries if e.path in first] +
+            [e for e in entries if e.path not in first]
+        )
+
+    for entry in entries:
+        src_item = entry.path
+        if entry.name in names:
+            error(f'not copying {src_item}, because an item named '
+                f'{entry.name} was already copied by this rule'
+            )
+            continue
+        names.add(entry.name)
+
+        #  TODO compare mtimes here to decide whether to copy?
+        dst_item = join(dst, entry.name)
+        # Finishing partial copies (staged, or made in place) regardless of
+        # age.
+        if dst_index.has_journal(dst_item):
+            info(f'{dst_item} was only partially copied. resuming.')
+            yield src_item, dst_item
+        elif not dst_index.exists(dst_item):
+            if not too_old(entry):
+                yield src_item, dst_item
+        elif copy_options['sync']:
+            if not too_old(entry):
+                info(f'{dst_item} already existed at destination. syncing.')
+                yield src_item, dst_item
+        else:
+            info(f'{dst_item} already existed at destination')
+
+
+def format_duration(s):
+    if s is None:
+        return 'unknown'
+
+    minutes, s = divmod(round(s), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours > 0:
+        return f'{hours}h{minutes:02d}m'
+    elif minutes > 0:
+        return f'{minutes}m{s:02d}s'
+    else:
+        return f'{s}s'
+
+
+def plan_rules(config, shipped, mtime_cache, history):
+    """
+    Returns list of dicts describing what main would copy for each rule (and
+    how long it should take), without copying anything.
+    """
+    src2walk = get_source_walks(config)
+
+    current_time_s = time.time()
+    rule_plans = []
+    for rn, rule in prioritized_rules(config, history):
+        src = join(root, rule['from'])
+        dst = rule['to']
+        rule_plan = {'rule': rn, 'from': src, 'to': dst}
+        rule_plans.append(rule_plan)
+        if not isdir(src) or not isdir(dst):
+            rule_plan['error'] = (f'rule source {src} was not an existing '
+                'directory' if not isdir(src) else
+                f'rule destination {dst} was not an existing directory'
+            )
+            src2walk[src].drop_rule(rn)
+            continue
+
+        dst_index = copy_engine.DestinationIndex(dst, shipped=shipped)
+        copy_options = copy_engine.get_copy_options(config, rule)
+        rule_stats = copy_engine.CopyStats()
+        exclude = source_scan.rule_selector(rule).excluder(src)
+        n_items = 0
+        for src_item, dst_item in rule_item_pairs(rn, src2walk[src], dst,
+            dst_index, copy_options, get_max_age_s(config, rule),
+            get_order(config, rule), mtime_cache, current_time_s,
+            first=history.deferred(src, dst)):
+
+            n_items += 1
+            rule_stats.merge(copy_engine.plan_item(src_item, dst_item,
+                copy_options, dst_index, exclude
+            ))
+
+        rule_plan.update({
+            'n_items': n_items,
+            'n_files': rule_stats.n_files_copied,
+            'n_bytes': rule_stats.n_bytes_copied,
+            'n_files_up_to_date': rule_stats.n_files_skipped,
+            'n_bytes_up_to_date': rule_stats.n_bytes_skipped,
+            'bytes_per_s': None,
+            'n_past_runs': 0,
+            'predicted_duration_s': None
+        })
+        throughput = history.throughput(src, dst)
+        if throughput is not None:
+            bytes_per_s, n_runs = throughput
+            rule_plan.update({
+                'bytes_per_s': bytes_per_s,
+                'n_past_runs': n_runs,
+                'predicted_duration_s': rule_stats.n_bytes_copied / bytes_per_s
+            })
+
+    return rule_plans
+
+
+def free_bytes(path):
+    """
+    Returns bytes available (to non-root users) on the filesystem with path.
+    """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def free_space_problems(rule_plans):
+    """
+    Returns list of (destinations, bytes to copy, bytes free) for each
+    filesystem that rules would copy more to than it has space for.
+    """
+    dev2dsts = dict()
+    dev2n_bytes = dict()
+    for rule_plan in rule_plans:
+        if 'error' in rule_plan:
+            continue
+
+        dst = rule_plan['to']
+        dev = os.stat(dst).st_dev
+        dev2dsts.setdefault(dev, []).append(dst)
+        dev2n_bytes[dev] = dev2n_bytes.get(dev, 0) + rule_plan['n_bytes']
+
+    problems = []
+    for dev, dsts in dev2dsts.items():
+        n_free = free_bytes(dsts[0])
+        if dev2n_bytes[dev] > n_free:
+            problems.append((sorted(set(dsts)), dev2n_bytes[dev], n_free))
+
+    return problems
+
+
+def format_free_space_problem(dsts, n_bytes, n_free):
+    return (f'{copy_engine.format_bytes(n_bytes)} to copy to {", ".join(dsts)}'
+        f', but only {copy_engine.format_bytes(n_free)} free there'
+    )
+
+
+def plan(json_file=None):
+    """
+    Reports what main would copy for each rule (and how long it should take),
+    without copying anything. Also writes the report as JSON to json_file, if
+    passed.
+    """
+    config = load_config()
+    shipped = get_shipped_index(config)
+    mtime_cache = get_mtime_cache(config)
+    history = get_copy_history(config)
+
+    rule_plans = plan_rules(config, shipped, mtime_cache, history)
+    problems = free_space_problems(rule_plans)
+
+    for x in (shipped, mtime_cache, history):
+        if x is not None:
+            x.close()
+
+    lines = []
+    for rule_plan in rule_plans:
+        rn = rule_plan['rule']
+        lines.append(f'rule {rn}: {rule_plan["from"]} -> {rule_plan["to"]}')
+        if 'error' in rule_plan:
+            lines.append(f'  {rule_plan["error"]}')
+            continue
+
+        lines.append(f'  {rule_plan["n_items"]} items, '
+            f'{rule_plan["n_files"]} files '
+            f'({copy_engine.format_bytes(rule_plan["n_bytes"])}) to copy, '
+            f'{rule_plan["n_files_up_to_date"]} files '
+            f'({copy_engine.format_bytes(rule_plan["n_bytes_up_to_date"])}) '
+            'already up to date'
+        )
+        if rule_plan['bytes_per_s'] is None:
+            lines.append('  predicted duration: unknown (no past copies to '
+                'this destination)'
+            )
+        else:
+            bytes_per_s = copy_engine.format_bytes(rule_plan['bytes_per_s'])
+            lines.append('  predicted duration: '
+                f'{format_duration(rule_plan["predicted_duration_s"])} (at '
+                f'{bytes_per_s}/s, from {rule_plan["n_past_runs"]} past copies)'
+            )
+
+    planned = [p for p in rule_plans if 'error' not in p]
+    n_bytes = sum(p['n_bytes'] for p in planned)
+    durations = [p['predicted_duration_s'] for p in planned
+        if p['n_bytes'] > 0
+    ]
+    total_s = None if None in durations else sum(durations)
+    lines.append(f'total: {sum(p["n_files"] for p in planned)} files '
+        f'({copy_engine.format_bytes(n_bytes)}), predicted duration: '
+        f'{format_duration(total_s)}'
+    )
+    for problem in problems:
+        lines.append(f'not enough space: {format_free_space_problem(*problem)}')
+    print('\n'.join(lines))
+
+    if json_file is not None:
+        report = {
+            'mount_point': root,
+            'rules': rule_plans,
+            'n_files': sum(p['n_files'] for p in planned),
+            'n_bytes': n_bytes,
+            'predicted_duration_s': total_s,
+            'not_enough_space': [
+                {'to': dsts, 'n_bytes': n, 'n_bytes_free': n_free}
+                for dsts, n, n_free in problems
+            ]
+        }
+        with open(json_file, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return rule_plans
+
+
 def main():
     user = getpass.getuser()
     info(f'script is being run as user={user}')
@@ -75,17 +569,86 @@ def main():
 
     config = load_config()
 
+    shipped = get_shipped_index(config)
+    # Days between automatically reconciling the shipped index with each
+    # destination (None to only do so with --reconcile).
+    reconcile_days = config.get('shipped_index_reconcile_days', 7)
+
+    mtime_cache = get_mtime_cache(config)
+    history = get_copy_history(config)
+
+    time_budget_s = get_time_budget_s(config)
+    budget = None
+    if time_budget_s is not None:
+        info(f'time budget: {time_budget_s} seconds')
+        budget = copy_history.TimeBudget(time_budget_s, history)
+
     gui = util.ProgressGUI()
     # not exactly same as label in other case, but this is ok
     gui.set_drive_label(root)
 
+    # 'warn', 'refuse' (to copy anything), or 'off'. Checking needs the whole
+    # source scanned before anything is copied.
+    free_space_check = config.get('free_space_check', 'off')
+    if free_space_check not in ('off', 'warn', 'refuse'):
+        raise ValueError(f'unrecognized free_space_check {free_space_check}')
+
+    if free_space_check != 'off':
+        info('checking there is enough space for everything to be copied')
+        problems = free_space_problems(
+            plan_rules(config, shipped, mtime_cache, history)
+        )
+        for problem in problems:
+            error(f'not enough space: {format_free_space_problem(*problem)}')
+
+        if len(problems) > 0:
+            message = ('Not enough space at the destination:\n' +
+                '\n'.join(format_free_space_problem(*p) for p in problems)
+            )
+            if free_space_check == 'refuse':
+                gui.show_warning(message + '\n\nNothing will be copied.')
+                gui.destroy()
+                for x in (shipped, mtime_cache, history):
+                    if x is not None:
+                        x.close()
+                return
+
+            gui.show_warning(message + '\n\nCopying will start anyway, and '
+                'pause if space runs out.'
+            )
+
     # TODO somehow factor this loop out to share between this and
     # windows_on_usb_connect.py ?
 
+    src2walk = get_source_walks(config)
+    rate_limiter = get_rate_limiter(config)
+    rules = prioritized_rules(config, history)
+    rn2rule = dict(rules)
+    scheduler = get_rule_scheduler(config)
+
+    # Rules run in their own threads, but the GUI can only be used from this
+    # one, which calls anything they queue here while waiting for them.
+    main_calls = util.MainThreadCalls()
+
+    # rule number -> (rule text, or None once the rule is done, number of items
+    # done, number of items found so far), of rules that have started copying.
+    # The progress bar shows all of them together.
+    rule2progress = dict()
+    def update_progress(rn, rule_text, n_items_done, n_items):
+        rule2progress[rn] = (rule_text, n_items_done, n_items)
+        gui.set_progress(
+            '\n'.join(t for t, _, _ in rule2progress.values() if t is not None),
+            sum(d for _, d, _ in rule2progress.values()),
+            sum(n for _, _, n in rule2progress.values())
+        )
+
     current_time_s = time.time()
-    for rn, rule in enumerate(config['copy_rules']):
+    # rule number -> copy_engine.CopyStats, of rules that copied anything.
+    rule2stats = dict()
+    def run_rule(rn):
+        rule = rn2rule[rn]
         rule_start_time = time.time()
-        
+
         assert not rule['from'].startswith('/')
         src = join(root, rule['from'])
         dst = rule['to']
@@ -94,86 +657,284 @@ def main():
         # TODO maybe also show these errors in the gui
         if not isdir(src):
             error(f'rule source {src} was not an existing directory')
-            continue
-            
+            src2walk[src].drop_rule(rn)
+            return
+
         if not isdir(dst):
             error(f'rule destination {dst} was not an existing directory')
-            continue
-            
+            src2walk[src].drop_rule(rn)
+            return
+
         info(f'trying to copy items under {src} to {dst}')
-        
-        if 'glob' in rule:
-            globstr = rule['glob']
-        else:
-            globstr = '*'
-            
-        # TODO some nice call to recursively update (skip existing files,
-        # or those w/ equally recent (m?)time?)
-        
-        # For now, only recursively copying over top-level items that do
-        # not already exist at the destination.
-        
-        glob_items = glob.glob(join(src, globstr))
-
-        # Filtering these out first so progress bar is more meaningful.
-        filtered_glob_items = []
-        for src_item in glob_items:
-            #  TODO compare mtimes here to decide whether to copy?
-            dst_item = join(dst, split(src_item)[1])
-            if not exists(dst_item):
-                filtered_glob_items.append(src_item)
-            else:
-                info(f'{dst_item} already existed at destination')
-            del dst_item
-        glob_items = filtered_glob_items
-        
-        if len(glob_items) == 0:
-            info(f'no items to copy for rule {rn}!')
-            continue
-        
+
+        # So each "is it already there?" check below isn't a round trip to the
+        # NAS.
+        dst_index = copy_engine.DestinationIndex(dst, shipped=shipped)
+
+        copy_options = copy_engine.get_copy_options(config, rule)
+        info(f'copy options: {copy_options}')
+
+        max_age_s = get_max_age_s(config, rule)
+        if max_age_s is not None:
+            info(f'max age for copy: {max_age_s} seconds')
+
+        controller = None
+        if copy_options['adaptive_workers']:
+            # Named by drive and destination, since the best number of workers
+            # depends on both.
+            controller = copy_engine.ConcurrencyController(f'{root} -> {dst}',
+                copy_options
+            )
+
+        # Exclude patterns also apply to what is under the (directory) items.
+        exclude = source_scan.rule_selector(rule).excluder(src)
+
+        # Items deferred by the time budget last time are copied first.
+        rule_pairs = rule_item_pairs(rn, src2walk[src], dst, dst_index,
+            copy_options, max_age_s, get_order(config, rule), mtime_cache,
+            current_time_s, first=history.deferred(src, dst)
+        )
+        # src_item -> bytes it should take to copy (if using a time budget)
+        item2n_bytes = dict()
+        if budget is not None:
+            def sized_item_pairs(pairs):
+                for src_item, dst_item in pairs:
+                    # Not bothering once nothing else will fit.
+                    n_bytes = None
+                    if budget.time_left_s > 0:
+                        n_bytes = copy_engine.plan_item(src_item, dst_item,
+                            copy_options, dst_index, exclude
+                        ).n_bytes_copied
+
+                    item2n_bytes[src_item] = n_bytes
+                    yield src_item, dst_item, n_bytes
+
+            rule_pairs = sized_item_pairs(rule_pairs)
+
+        # Scanning (and filtering) the source in the background, so copies can
+        # start as soon as the first item to copy is found, rather than after
+        # the whole source has been listed. The scan can only get
+        # scan_queue_size items ahead of the copies.
+        item_pairs = copy_engine.Prefetcher(rule_pairs,
+            maxsize=copy_options['scan_queue_size']
+        )
+        pairs_to_copy = item_pairs
+        rule_deferred = []
+        if budget is not None:
+            # Copies stop (at item boundaries) once nothing else would finish
+            # within the budget, but what remains is still scanned, so it can
+            # be reported.
+            pairs_to_copy = budget.select(src, dst, item_pairs, rule_deferred)
+
+        def until_stopped(pairs):
+            for pair in pairs:
+                if scheduler.stop.is_set():
+                    info(f'not starting any more items of rule {rn}, since '
+                        'another rule failed'
+                    )
+                    return
+                yield pair
+
+        pairs_to_copy = until_stopped(pairs_to_copy)
+
+        def n_rule_items():
+            return item_pairs.n_produced - len(rule_deferred)
+
         # or just '{src} -> {dst}'?
         rule_text = f'Copying files from {src} to {dst}'
-        gui.set_rule(rule_text, len(glob_items))
-            
-        for src_item in glob_items:
-            dst_item = join(dst, split(src_item)[1])
-            info(f'{src_item} -> {dst_item}')
+        rule_started = False
+        n_items_done = 0
+        # Items can be started again, after running out of space.
+        started_items = set()
+        def on_start(src_item, dst_item):
+            nonlocal rule_started
+            # The total shown by the progress bar is refined (as the scan
+            # finds more items) after each copy finishes.
+            if not rule_started:
+                main_calls.post(update_progress, rn, rule_text, 0,
+                    n_rule_items()
+                )
+                rule_started = True
 
+            if budget is not None and src_item not in started_items:
+                budget.started(item2n_bytes[src_item])
+            started_items.add(src_item)
+
+            info(f'{src_item} -> {dst_item}')
             itemname = split(src_item)[1]
-            gui.set_item(itemname)
-            
-            before_copy = time.time()
-            try:
-                assert not exists(dst_item), f'{dst_item} existed before copy'
-                    
-                if isdir(src_item):
-                    copytree(src_item, dst_item)
-                else:
-                    # Assuming it was a file here.
-                    copy2(src_item, dst_item)
-                    
-                copy_duration_s = time.time() - before_copy
-                info(f'copying {src_item} took {copy_duration_s:.2f}s')
-                assert exists(dst_item), f'{dst_item} did not exist after copy'
-                    
-            # TODO maybe specifically check for IOError (and specific type
-            # that indicates insufficient space?), and handle (by pausing?)
-            # in that case, otherwise raise?
-            except Exception as e:
-                formatted_traceback = traceback.format_exc()
-                gui.show_error(src_item, str(e), formatted_traceback)
-                raise
-            
-            gui.step_progress()
-        
+            main_calls.post(gui.set_item, itemname)
+
+        # Time spent waiting for space to be freed, which should not count
+        # towards how long the copies took.
+        paused_s = 0.0
+        def on_no_space(dst_items, e):
+            nonlocal paused_s
+            before = time.time()
+            retry = main_calls.call(gui.ask_retry_no_space, dst_items, str(e))
+            duration_s = time.time() - before
+            paused_s += duration_s
+            if budget is not None:
+                budget.paused(duration_s)
+
+            return retry
+
+        rule_stats = copy_engine.CopyStats()
+        copy_start_time = time.time()
+        try:
+            # Running out of space pauses copying, until the user says space
+            # has been freed.
+            for src_item, dst_item, e in copy_engine.copy_items(pairs_to_copy,
+                options=copy_options, on_start=on_start, stats=rule_stats,
+                dst_index=dst_index, controller=controller,
+                rate_limiter=rate_limiter, exclude=exclude,
+                on_no_space=on_no_space):
+
+                if e is not None:
+                    # So the other rules stop starting items while the error
+                    # is shown.
+                    scheduler.stop.set()
+                    formatted_traceback = ''.join(
+                        traceback.format_exception(type(e), e, e.__traceback__)
+                    )
+                    main_calls.call(gui.show_error, src_item, str(e),
+                        formatted_traceback
+                    )
+                    raise e
+
+                if budget is not None:
+                    budget.finished(item2n_bytes[src_item])
+
+                n_items_done += 1
+                main_calls.post(update_progress, rn, rule_text, n_items_done,
+                    n_rule_items()
+                )
+        finally:
+            item_pairs.close()
+
+        if controller is not None:
+            info(controller.summary())
+
+        if rule_started:
+            main_calls.post(update_progress, rn, None, n_items_done,
+                n_items_done
+            )
+
+        # Items this rule copied either resumed from or removed their own staged
+        # copies, so anything still staged belongs to an item it did not copy.
+        for staged, dst_item in dst_index.staged():
+            if dst_index.exists(dst_item):
+                info(f'removing leftover {staged} ({dst_item} is complete)')
+                copy_engine.remove_path(staged)
+                dst_index.discard(staged)
+            else:
+                error(f'found incomplete copy {staged}, which this rule will '
+                    'not copy again'
+                )
+
+        # What is left of this rule was neither copied nor deferred.
+        if scheduler.stop.is_set():
+            return
+
+        # Replacing what was deferred last time, which has now been copied (or
+        # deferred again).
+        history.set_deferred(src, dst, rule_deferred)
+
+        if item_pairs.n_produced == 0:
+            info(dst_index.summary())
+            info(f'no items to copy for rule {rn}!')
+            return
+
+        # For predicting how long later copies will take (see --plan).
+        if rule_stats.n_files_copied > 0:
+            history.record(src, dst, rule_stats.n_files_copied,
+                rule_stats.n_bytes_copied,
+                time.time() - copy_start_time - paused_s
+            )
+
+        info(dst_index.summary())
+        rule_summary = rule_stats.summary()
+        if len(rule_deferred) > 0:
+            rule_summary += (f', {len(rule_deferred)} items deferred by time '
+                'budget'
+            )
+        info(f'rule {rn}: {rule_summary}')
+        main_calls.post(gui.set_summary, rule_summary)
+        rule2stats[rn] = rule_stats
+
         # TODO compare copy duration to native linux copy
         ruledur_s = time.time() - rule_start_time
         info(f'done processing rule {rn} (took {ruledur_s:.2f}s)')
 
+    last_rate_shown = 0
+    def wait_for_rules(futures):
+        nonlocal last_rate_shown
+        while not any(f.done() for f in futures):
+            main_calls.run_pending(timeout_s=0.1)
+            if rate_limiter is not None and time.time() - last_rate_shown > 1:
+                gui.set_rate(rate_limiter.summary())
+                last_rate_shown = time.time()
+
+    rule2exception = scheduler.run(
+        [(rn, join(root, rule['from']), rule['to']) for rn, rule in rules],
+        run_rule, wait_for_rules
+    )
+    # Anything the rules queued after the last of them was waited for.
+    main_calls.run_pending(timeout_s=0)
+
+    # Raising the error of the first rule (in priority order) that failed.
+    for rn, _ in rules:
+        if rule2exception.get(rn) is not None:
+            raise rule2exception[rn]
+
+    total_stats = copy_engine.CopyStats()
+    for rn, _ in rules:
+        if rn in rule2stats:
+            total_stats.merge(rule2stats[rn])
+
     # This gets destroyed in some of the next calls, so I'm copying it now
-    # for use later.
-    something_was_copied = gui.something_was_copied
+    # for use later. Items that were only synced may not have had anything
+    # copied.
+    something_was_copied = (gui.something_was_copied and
+        total_stats.n_files_copied > 0
+    )
     
+    if shipped is not None:
+        # Only once all copies are done, as this walks the whole destination
+        # (on the NAS). Each destination once, however many rules copy to it.
+        if reconcile_days is not None:
+            dsts = dict.fromkeys(rn2rule[rn]['to'] for rn in rule2exception)
+            for dst in dsts:
+                if not isdir(dst):
+                    continue
+
+                last_reconciled = shipped.last_reconciled(dst)
+                if (last_reconciled is None or time.time() - last_reconciled >
+                    reconcile_days * 24 * 3600):
+
+                    info(f'shipped index not reconciled with {dst} in last '
+                        f'{reconcile_days} days. reconciling.'
+                    )
+                    shipped.reconcile(dst)
+
+        shipped.close()
+
+    if mtime_cache is not None:
+        info(mtime_cache.summary())
+        mtime_cache.close()
+
+    if budget is not None and len(budget.deferred) > 0:
+        n_bytes = sum(n or 0 for _, _, n in budget.deferred)
+        info(f'{len(budget.deferred)} items (at least '
+            f'{copy_engine.format_bytes(n_bytes)}) were deferred by the time '
+            'budget, and will be copied first next time:'
+        )
+        for src_item, dst_item, n_bytes in budget.deferred:
+            size = 'size unknown' if n_bytes is None else \
+                copy_engine.format_bytes(n_bytes)
+            info(f'  {src_item} -> {dst_item} ({size})')
+
+    history.close()
+
     gui.all_copies_successful = True
     gui.final_notifications()
     # TODO destroy?
@@ -304,5 +1065,28 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reconcile', action='store_true', help='update the '
+        'shipped index (if enabled in config) to match what is actually at '
+        'each rule destination, then exit'
+    )
+    parser.add_argument('--plan', action='store_true', help='report the '
+        'number of files and bytes each rule would copy, and how long that '
+        'should take (from past copies), without copying anything. '
+        f'{evar} must be set to the .mount unit of the drive.'
+    )
+    parser.add_argument('--json', metavar='FILE', help='with --plan, also '
+        'write the report as JSON to FILE'
+    )
+    args = parser.parse_args()
+    # The log also goes to stdout, so JSON there couldn't be parsed.
+    if args.json == '-':
+        parser.error('--json needs a file path (stdout also has the log)')
+
+    if args.reconcile:
+        reconcile()
+    elif args.plan:
+        plan(json_file=args.json)
+    else:
+        main()
 
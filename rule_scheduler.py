@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Running copy rules concurrently, as long as they don't read from / write to a
+device that already has as many rules using it as it is allowed.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+import os
+import threading
+
+
+l = logging.getLogger(__name__)
+
+
+def _device(path):
+    try:
+        return os.stat(path).st_dev
+    # Rules with missing directories just fail quickly, whatever they run with.
+    except FileNotFoundError:
+        return None
+
+
+class RuleScheduler:
+    """
+    Runs rules in the order given, except that a rule only starts once fewer
+    than max_per_source_device rules are running reading from the same device
+    as it, and fewer than max_per_destination_device are writing to the same
+    device (st_dev) as it. Later rules that can start are started in the
+    meantime.
+    """
+    def __init__(self, max_per_source_device=1, max_per_destination_device=1):
+        assert max_per_source_device >= 1 and max_per_destination_device >= 1
+        self.max_per_source_device = max_per_source_device
+        self.max_per_destination_device = max_per_destination_device
+        # Set if a rule fails, so others can stop at their next item.
+        self.stop = threading.Event()
+
+
+    def _devices(self, src, dst):
+        return [(kind, dev, cap) for kind, dev, cap in (
+            ('source', _device(src), self.max_per_source_device),
+            ('destination', _device(dst), self.max_per_destination_device)
+        ) if dev is not None]
+
+
+    def run(self, rules, run_rule, wait_fn=None):
+        """
+        rules should be a list of (key, src, dst), and run_rule(key) will be
+        called (in a separate thread) for each.
+
+        wait_fn(futures), which should return once any of them are done, can be
+        passed to do something else (e.g. update a GUI) in the calling thread
+        while waiting. Returns dict of key -> exception (None if the rule
+        succeeded), only including rules that were started, which stops after
+        any rule fails.
+        """
+        if wait_fn is None:
+            wait_fn = lambda futures: wait(futures,
+                return_when=FIRST_COMPLETED
+            )
+
+        pending = [(key, self._devices(src, dst)) for key, src, dst in rules]
+        # (kind, device) -> number of running rules using it
+        n_running = dict()
+        future2rule = dict()
+        key2exception = dict()
+        with ThreadPoolExecutor(max_workers=max(len(rules), 1)) as pool:
+            while len(pending) > 0 or len(future2rule) > 0:
+                for key, devices in list(pending):
+                    if self.stop.is_set():
+                        break
+
+                    if any(n_running.get((kind, dev), 0) >= cap
+                        for kind, dev, cap in devices):
+                        continue
+
+                    pending.remove((key, devices))
+                    for kind, dev, _ in devices:
+                        n_running[(kind, dev)] = n_running.get((kind, dev),
+                            0) + 1
+
+                    l.info(f'starting rule {key} ({len(future2rule)} other '
+                        'rules running)'
+                    )
+                    future2rule[pool.submit(run_rule, key)] = (key, devices)
+
+                if self.stop.is_set():
+                    pending = []
+
+                if len(future2rule) == 0:
+                    break
+
+                wait_fn(list(future2rule))
+                for future in [f for f in future2rule if f.done()]:
+                    key, devices = future2rule.pop(future)
+                    for kind, dev, _ in devices:
+                        n_running[(kind, dev)] -= 1
+
+                    e = future.exception()
+                    key2exception[key] = e
+                    if e is not None:
+                        l.error(f'rule {key} failed. not starting any more '
+                            'rules.'
+                        )
+                        self.stop.set()
+
+        return key2exception
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent (SQLite) index of the items (and the files in them) that have been
+copied ("shipped") to each destination, so that planning which items to copy
+doesn't need to list / stat anything on the NAS.
+"""
+
+import logging
+import os
+from os.path import join, split, normpath
+import sqlite3
+import threading
+import time
+
+
+l = logging.getLogger(__name__)
+
+default_index_file = join(split(__file__)[0], 'shipped_index.sqlite')
+
+
+class ShippedIndex:
+    def __init__(self, path=default_index_file):
+        self.path = path
+        # Copies finish (and are recorded) in worker threads.
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.executescript('''
+                CREATE TABLE IF NOT EXISTS items (
+                    dst TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    shipped_at REAL NOT NULL,
+                    PRIMARY KEY (dst, name)
+                );
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    dst TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    digest TEXT
+                );
+                CREATE INDEX IF NOT EXISTS files_by_item ON files (dst, name);
+                CREATE TABLE IF NOT EXISTS reconciles (
+                    dst TEXT PRIMARY KEY,
+                    reconciled_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS pending (
+                    dst TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    PRIMARY KEY (dst, name)
+                );
+            ''')
+
+
+    def names(self, dst):
+        """
+        Returns set of names of items shipped directly under dst.
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT name FROM items WHERE dst = ?',
+                (normpath(dst),)
+            ).fetchall()
+
+        return {name for name, in rows}
+
+
+    def pending_names(self, dst):
+        """
+        Returns set of names of staged copies and copy journals (hidden entries
+        left while items are copied) recorded directly under dst.
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT name FROM pending WHERE dst = ?',
+                (normpath(dst),)
+            ).fetchall()
+
+        return {name for name, in rows}
+
+
+    def add_pending(self, path):
+        dst, name = split(normpath(path))
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR IGNORE INTO pending VALUES (?, ?)',
+                (dst, name)
+            )
+
+
+    def discard_pending(self, path):
+        dst, name = split(normpath(path))
+        with self._lock, self._conn:
+            self._conn.execute(
+                'DELETE FROM pending WHERE dst = ? AND name = ?', (dst, name)
+            )
+
+
+    def file_state(self, path):
+        """
+        Returns (size, mtime) of the shipped file at path, or None if unknown.
+        """
+        with self._lock:
+            return self._conn.execute(
+                'SELECT size, mtime FROM files WHERE path = ?', (path,)
+            ).fetchone()
+
+
+    def record_item(self, dst_item, files):
+        """
+        Records dst_item as completely shipped, along with files, which should
+        be a list of (path, size, mtime, digest) (digest may be None) for files
+        under dst_item that were copied or checked. Other files already recorded
+        for the item are kept.
+        """
+        dst, name = split(normpath(dst_item))
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?)',
+                (dst, name, time.time())
+            )
+            # Keeping any digest we already had, if the file is unchanged and
+            # we weren't given a new one.
+            self._conn.executemany('''
+                INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    size = excluded.size,
+                    mtime = excluded.mtime,
+                    digest = COALESCE(excluded.digest, CASE
+                        WHEN files.size = excluded.size AND
+                            files.mtime = excluded.mtime
+                        THEN files.digest
+                    END)
+                ''', [(path, dst, name, size, mtime, digest)
+                    for path, size, mtime, digest in files
+                ]
+            )
+
+
+    def last_reconciled(self, dst):
+        """
+        Returns time dst was last reconciled (in seconds since the epoch), or
+        None if it never was.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT reconciled_at FROM reconciles WHERE dst = ?',
+                (normpath(dst),)
+            ).fetchone()
+
+        return None if row is None else row[0]
+
+
+    def reconcile(self, dst):
+        """
+        Replaces everything recorded under dst with what is actually there.
+
+        Hidden entries (journals, staged copies, manifests) are not recorded as
+        items, and neither are items that still have a copy journal (see
+        copy_engine.journal_path), as they are not complete. Staged copies and
+        journals are recorded as pending instead (see pending_names).
+        """
+        dst = normpath(dst)
+        before = time.time()
+        old_names = self.names(dst)
+
+        names = []
+        pending = []
+        files = []
+        def add_file(path, name):
+            st = os.stat(path)
+            files.append((path, dst, name, st.st_size, st.st_mtime, None))
+
+        with os.scandir(dst) as entries:
+            entries = list(entries)
+
+        all_names = {entry.name for entry in entries}
+        for entry in entries:
+            if entry.name.startswith('.'):
+                if entry.name.endswith(('.staging', '.copy_journal')):
+                    pending.append(entry.name)
+                continue
+
+            if f'.{entry.name}.copy_journal' in all_names:
+                continue
+
+            names.append(entry.name)
+            if entry.is_dir():
+                for dirpath, _, filenames in os.walk(entry.path):
+                    for filename in filenames:
+                        add_file(join(dirpath, filename), entry.name)
+            else:
+                add_file(entry.path, entry.name)
+
+        with self._lock, self._conn:
+            # Keeping digests of files that are still the same size and mtime,
+            # since we can't cheaply recompute them here.
+            old_digests = {(path, size, mtime): digest for path, size, mtime,
+                digest in self._conn.execute('SELECT path, size, mtime, digest'
+                    ' FROM files WHERE dst = ?', (dst,)
+                )
+            }
+            files = [(path, d, name, size, mtime,
+                old_digests.get((path, size, mtime)))
+                for path, d, name, size, mtime, _ in files
+            ]
+
+            self._conn.execute('DELETE FROM items WHERE dst = ?', (dst,))
+            self._conn.execute('DELETE FROM files WHERE dst = ?', (dst,))
+            self._conn.execute('DELETE FROM pending WHERE dst = ?', (dst,))
+            now = time.time()
+            self._conn.executemany('INSERT INTO items VALUES (?, ?, ?)',
+                [(dst, name, now) for name in names]
+            )
+            self._conn.executemany(
+                'INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)', files
+            )
+            self._conn.executemany('INSERT INTO pending VALUES (?, ?)',
+                [(dst, name) for name in pending]
+            )
+            self._conn.execute(
+                'INSERT OR REPLACE INTO reconciles VALUES (?, ?)', (dst, now)
+            )
+
+        added = set(names) - old_names
+        removed = old_names - set(names)
+        l.info(f'reconciled shipped index with {dst} in '
+            f'{time.time() - before:.2f}s ({len(names)} items, {len(files)} '
+            f'files. {len(added)} items added, {len(removed)} removed)'
+        )
+        return added, removed
+
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+"""
+Selecting which items under a rule's source to copy, with include / exclude
+glob patterns (supporting ** for any number of directories), in a single walk
+of each source directory that is shared by all rules reading from it.
+"""
+
+from collections import deque
+from fnmatch import translate
+import json
+import logging
+import os
+from os.path import join, split, normcase, relpath
+import re
+import sqlite3
+import threading
+
+
+l = logging.getLogger(__name__)
+
+default_mtime_cache_file = join(split(__file__)[0], 'newest_mtime_cache.sqlite')
+
+
+def _split(path):
+    return [p for p in re.split(r'[\\/]', path) if p and p != '.']
+
+
+class Pattern:
+    """
+    A glob pattern, relative to the source directory, compiled once.
+
+    As with glob, * and ? do not match across directories or match hidden
+    names (unless the pattern component itself starts with '.'), and a ** path
+    component matches any number (including zero) of non-hidden directories.
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self._components = []
+        for component in _split(pattern):
+            if component == '**':
+                self._components.append(None)
+            else:
+                self._components.append((component.startswith('.'),
+                    re.compile(translate(normcase(component)))
+                ))
+
+
+    @staticmethod
+    def _component_matches(component, part):
+        hidden_ok, regex = component
+        if part.startswith('.') and not hidden_ok:
+            return False
+
+        return regex.match(normcase(part)) is not None
+
+
+    def _match(self, i, parts, prefix):
+        components = self._components
+        if len(parts) == 0:
+            # Something under the path could still match, as long as pattern
+            # components remain.
+            return i < len(components) if prefix else (
+                all(c is None for c in components[i:])
+            )
+
+        if i == len(components):
+            return False
+
+        component = components[i]
+        if component is None:
+            # ** either matches nothing more, or this part (and maybe more).
+            if self._match(i + 1, parts, prefix):
+                return True
+
+            return (not parts[0].startswith('.') and
+                self._match(i, parts[1:], prefix)
+            )
+
+        return (self._component_matches(component, parts[0]) and
+            self._match(i + 1, parts[1:], prefix)
+        )
+
+
+    def match(self, parts):
+        """
+        Whether the path with these components (relative to the source) matches.
+        """
+        return self._match(0, parts, False)
+
+
+    def could_match_under(self, parts):
+        """
+        Whether anything under the directory with these components could match.
+        """
+        return self._match(0, parts, True)
+
+
+class RuleSelector:
+    """
+    Include and exclude patterns of one rule. Directories that are included are
+    copied as a whole (as one item), so nothing under them is selected
+    separately, but anything in them matching an exclude pattern is not copied
+    (see excluder). Excluded directories are not walked into.
+    """
+    def __init__(self, include=('*',), exclude=()):
+        self.include = [Pattern(p) for p in include]
+        self.exclude = [Pattern(p) for p in exclude]
+
+
+    def excluded(self, parts):
+        return any(p.match(parts) for p in self.exclude)
+
+
+    def excluder(self, root):
+        """
+        Returns function of a path under root (the rule's source), returning
+        whether it is excluded, or None if there are no exclude patterns.
+        """
+        if len(self.exclude) == 0:
+            return None
+
+        return lambda path: self.excluded(_split(relpath(path, root)))
+
+
+    def selects(self, parts):
+        return (any(p.match(parts) for p in self.include) and
+            not self.excluded(parts)
+        )
+
+
+    def should_descend(self, parts):
+        return (not self.excluded(parts) and
+            not any(p.match(parts) for p in self.include) and
+            any(p.could_match_under(parts) for p in self.include)
+        )
+
+
+def _as_list(patterns):
+    if isinstance(patterns, str):
+        return [patterns]
+
+    return list(patterns)
+
+
+def rule_selector(rule):
+    """
+    Returns RuleSelector for a rule's include (or older glob) and exclude
+    patterns, each either one pattern or a list of them.
+    """
+    if 'include' in rule:
+        assert 'glob' not in rule, 'rule should only have one of include / glob'
+        include = _as_list(rule['include'])
+    elif 'glob' in rule:
+        include = [rule['glob']]
+    else:
+        include = ['*']
+
+    return RuleSelector(include, _as_list(rule.get('exclude', [])))
+
+
+class SourceWalk:
+    """
+    Walks a source directory (lazily, as the items are consumed) once, for all
+    the rules added with add_rule, each of which gets its items from
+    items(key).
+    """
+    def __init__(self, root):
+        self.root = root
+        self._key2selector = dict()
+        self._key2queue = dict()
+        self._lock = threading.Lock()
+        # (parts of directory, iterator over its entries) for each directory
+        # being walked.
+        self._stack = None
+        self.done = False
+        self.n_dirs_listed = 0
+
+
+    def add_rule(self, key, selector):
+        assert self._stack is None, 'rules must be added before walking'
+        self._key2selector[key] = selector
+        self._key2queue[key] = deque()
+
+
+    def drop_rule(self, key):
+        """
+        Stops collecting items for a rule that will not consume them.
+        """
+        with self._lock:
+            self._key2selector.pop(key, None)
+            self._key2queue.pop(key, None)
+
+
+    def _scandir(self, path, parts):
+        self.n_dirs_listed += 1
+        self._stack.append((parts, os.scandir(path)))
+
+
+    def _advance(self):
+        """
+        Handles the next entry of the walk. Must hold lock.
+        """
+        if self._stack is None:
+            self._stack = []
+            self._scandir(self.root, [])
+
+        parts, entries = self._stack[-1]
+        entry = next(entries, None)
+        if entry is None:
+            entries.close()
+            self._stack.pop()
+            if len(self._stack) == 0:
+                self.done = True
+                l.debug(f'walked {self.root} ({self.n_dirs_listed} '
+                    'directories listed)'
+                )
+            return
+
+        entry_parts = parts + [entry.name]
+        descend = False
+        for key, selector in self._key2selector.items():
+            if selector.selects(entry_parts):
+                self._key2queue[key].append(entry)
+
+            elif (entry.is_dir(follow_symlinks=False) and
+                selector.should_descend(entry_parts)):
+                descend = True
+
+        if descend:
+            self._scandir(entry.path, entry_parts)
+
+
+    def items(self, key):
+        """
+        Yields os.DirEntry for each item selected by the rule added with key.
+        """
+        while True:
+            with self._lock:
+                queue = self._key2queue[key]
+                while len(queue) == 0 and not self.done:
+                    self._advance()
+
+                if len(queue) == 0:
+                    return
+
+                entry = queue.popleft()
+
+            yield entry
+
+
+class NewestMtimeCache:
+    """
+    Newest mtime (and total size) of everything under each directory, for
+    filtering and ordering items.
+
+    For each directory, the newest mtime and total size of the (non-directory)
+    entries directly in it, and the names of its subdirectories, are cached (in
+    SQLite, so they persist between connections), keyed on the directory's own
+    mtime. Adding, removing or renaming entries changes that, so a directory is
+    only listed again if that happened, and otherwise only its subdirectories
+    are stat-ed. Files modified in place (without being replaced) do not change
+    their directory's mtime, and so are not noticed in directories already
+    cached.
+    """
+    def __init__(self, path=default_mtime_cache_file):
+        self.path = path
+        # Items are checked in the thread scanning each rule's source.
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            columns = [row[1] for row in
+                self._conn.execute('PRAGMA table_info(dirs)')
+            ]
+            # Caches from before sizes were also stored. Nothing lost but time.
+            if columns and 'size' not in columns:
+                self._conn.execute('DROP TABLE dirs')
+
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS dirs (
+                    path TEXT PRIMARY KEY,
+                    mtime REAL NOT NULL,
+                    newest REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    subdirs TEXT NOT NULL
+                )
+            ''')
+        # item path -> (newest mtime, size), so each item is only summarized
+        # once per connection (e.g. for both filtering and ordering).
+        self._item2summary = dict()
+        self.n_dirs_listed = 0
+        self.n_dirs_cached = 0
+
+
+    def _summarize_dir(self, path, dir_mtime, updates):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT mtime, newest, size, subdirs FROM dirs WHERE path = ?',
+                (path,)
+            ).fetchone()
+
+        if row is not None and row[0] == dir_mtime:
+            _, newest, size, subdirs = row
+            subdir_mtimes = []
+            try:
+                for name in json.loads(subdirs):
+                    subdir = join(path, name)
+                    subdir_mtimes.append((subdir,
+                        os.stat(subdir, follow_symlinks=False).st_mtime
+                    ))
+            # Can only happen if things changed since we got dir_mtime.
+            except FileNotFoundError:
+                row = None
+            else:
+                self.n_dirs_cached += 1
+
+        if row is None or row[0] != dir_mtime:
+            self.n_dirs_listed += 1
+            newest = dir_mtime
+            size = 0
+            subdir_mtimes = []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    st = entry.stat(follow_symlinks=False)
+                    if entry.is_dir(follow_symlinks=False):
+                        subdir_mtimes.append((entry.path, st.st_mtime))
+                    else:
+                        newest = max(newest, st.st_mtime)
+                        size += st.st_size
+
+            updates.append((path, dir_mtime, newest, size, json.dumps(
+                [split(subdir)[1] for subdir, _ in subdir_mtimes]
+            )))
+
+        for subdir, subdir_mtime in subdir_mtimes:
+            subdir_newest, subdir_size = self._summarize_dir(subdir,
+                subdir_mtime, updates
+            )
+            newest = max(newest, subdir_newest)
+            size += subdir_size
+
+        return newest, size
+
+
+    def _summarize(self, entry):
+        """
+        Returns (newest mtime, total size) of the os.DirEntry entry and
+        everything under it.
+        """
+        if entry.path in self._item2summary:
+            return self._item2summary[entry.path]
+
+        st = entry.stat()
+        if not entry.is_dir():
+            return st.st_mtime, st.st_size
+
+        updates = []
+        summary = self._summarize_dir(entry.path, st.st_mtime, updates)
+        if updates:
+            with self._lock, self._conn:
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)',
+                    updates
+                )
+
+        self._item2summary[entry.path] = summary
+        return summary
+
+
+    def newest_mtime(self, entry):
+        """
+        Returns newest mtime of the os.DirEntry entry or anything under it.
+        """
+        return self._summarize(entry)[0]
+
+
+    def total_size(self, entry):
+        """
+        Returns total size of the files in (or just size of) os.DirEntry entry.
+        """
+        return self._summarize(entry)[1]
+
+
+    def summary(self):
+        return (f'newest mtimes: {self.n_dirs_listed} directories listed, '
+            f'{self.n_dirs_cached} unchanged since cached'
+        )
+
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Orders that need the newest mtime / total size of each item (see
+# NewestMtimeCache).
+item_orders = {
+    'newest-first': ('newest_mtime', True),
+    'oldest-first': ('newest_mtime', False),
+    'smallest-first': ('total_size', False),
+    'largest-first': ('total_size', True),
+    'name': ('name', False),
+}
+
+
+def _order_key_and_reverse(order):
+    """
+    Returns (key, reverse) for order, which is either one of item_orders, or a
+    dict with 'by' (one of 'newest_mtime', 'total_size' or 'name'), and
+    optionally 'reverse' and (when by 'name') 'pattern' (a regex, where the
+    first group, or the whole match, of each name is used as the key, e.g. to
+    sort by a date somewhere in the name. Items that don't match go last).
+    """
+    if isinstance(order, str):
+        if order not in item_orders:
+            raise ValueError(f'unrecognized order {order}. should be one of '
+                f'{list(item_orders)} or a dict with "by"'
+            )
+        return item_orders[order] + (None,)
+
+    by = order.get('by', 'name')
+    if by not in ('newest_mtime', 'total_size', 'name'):
+        raise ValueError(f'unrecognized order by value {by}')
+
+    pattern = order.get('pattern')
+    if pattern is not None:
+        pattern = re.compile(pattern)
+    return by, order.get('reverse', False), pattern
+
+
+def needs_item_stats(order):
+    return order is not None and _order_key_and_reverse(order)[0] != 'name'
+
+
+def order_items(entries, order, mtime_cache=None):
+    """
+    Returns list of os.DirEntry entries sorted according to order (see
+    _order_key_and_reverse). Only uses stats from the scan (and mtime_cache,
+    which is required unless only ordering by name).
+    """
+    by, reverse, pattern = _order_key_and_reverse(order)
+    if by == 'name':
+        if pattern is None:
+            return sorted(entries, key=lambda e: e.name, reverse=reverse)
+
+        matched = []
+        unmatched = []
+        for entry in entries:
+            match = pattern.search(entry.name)
+            if match is None:
+                unmatched.append(entry)
+            else:
+                key = match.group(1) if pattern.groups else match.group()
+                matched.append((key, entry))
+
+        matched.sort(key=lambda x: x[0], reverse=reverse)
+        return [entry for _, entry in matched] + unmatched
+
+    key = getattr(mtime_cache, by)
+    return sorted(entries, key=key, reverse=reverse)
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import Future
 from os.path import join, splitext
 from datetime import datetime
 import logging
 import logging.handlers
+import queue
 import sys
+import threading
 import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox
@@ -71,9 +74,75 @@ def service_unit_config_file(service_unit):
     return f'{config_prefix}_config.yaml'
 
 
+class MainThreadCalls:
+    """
+    For calling functions (e.g. of ProgressGUI, which should only be used from
+    the main thread) from other threads. They are only actually called when
+    the main thread calls run_pending. Calls from the main thread itself happen
+    immediately.
+    """
+    def __init__(self):
+        self._queue = queue.Queue()
+
+
+    def call(self, fn, *args):
+        """
+        Calls fn(*args) in the main thread, waiting for it to return, and
+        returns (or raises) what it did.
+        """
+        if threading.current_thread() is threading.main_thread():
+            return fn(*args)
+
+        future = Future()
+        self._queue.put((fn, args, future))
+        return future.result()
+
+
+    def post(self, fn, *args):
+        """
+        Like call, but without waiting for fn to be called.
+        """
+        if threading.current_thread() is threading.main_thread():
+            fn(*args)
+            return
+
+        self._queue.put((fn, args, None))
+
+
+    def run_pending(self, timeout_s=None):
+        """
+        Calls everything queued so far, first waiting up to timeout_s (forever
+        if None) for anything to be queued, if nothing is.
+        """
+        assert threading.current_thread() is threading.main_thread()
+        try:
+            item = self._queue.get(timeout=timeout_s)
+        except queue.Empty:
+            return
+
+        while True:
+            fn, args, future = item
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                # Nothing is waiting to get this, so raising it here instead.
+                if future is None:
+                    raise
+                future.set_exception(e)
+            else:
+                if future is not None:
+                    future.set_result(result)
+
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+
+
 class ProgressGUI:
     def _init_state_vars(self):
         self.n_rule_items = None
+        self.n_rule_items_done = 0
         self.something_was_copied = False
         # TODO this make sense to have here? have show_error mark it false, and
         # start it true (or does that not track meaning of it in windows gui
@@ -126,6 +195,11 @@ class ProgressGUI:
             variable=self.progress_var, maximum=100
         )
         self.progress.pack(expand=1, fill='both')
+
+        # Only set if copy bandwidth is limited.
+        self.rate_var = tk.StringVar()
+        self.rate_label = ttk.Label(self.tk_root, textvariable=self.rate_var)
+        self.rate_label.pack()
         self.tk_root.update()
 
 
@@ -140,6 +214,7 @@ class ProgressGUI:
 
     def set_rule(self, rule_text, n_rule_items):
         self.n_rule_items = n_rule_items
+        self.n_rule_items_done = 0
 
         self.rule_var.set(rule_text)
         self.progress_var.set(0.0)
@@ -156,20 +231,50 @@ class ProgressGUI:
         self.something_was_copied = True
 
 
-    def step_progress(self):
-        assert self.n_rule_items is not None
+    def set_summary(self, summary_text):
+        # Replacing the item name, since we are done with the rule's items.
+        self.itemname_var.set(summary_text)
+        self.itemname_label.update()
+        self.tk_root.update()
+
 
+    def _update_progress(self):
         # TODO move hardcoded 100 to some var shared w/ other thing that made
         # 100 the right value here...
 
         # Not counting the fact that the items may take different
         # amounts of time to copy.
-        progress_step = 100 / self.n_rule_items
-        self.progress.step(progress_step)
+        progress = 100 * self.n_rule_items_done / max(self.n_rule_items, 1)
+        self.progress_var.set(min(progress, 100.0))
         self.progress.update()
         self.tk_root.update()
 
 
+    def set_progress(self, rule_text, n_items_done, n_items):
+        """
+        Shows progress of n_items_done out of n_items (e.g. over several rules
+        copying at once), with rule_text in place of that of one rule.
+        """
+        self.n_rule_items = n_items
+        self.n_rule_items_done = n_items_done
+        self.rule_var.set(rule_text)
+        self.rule_label.update()
+        self._update_progress()
+
+
+    def set_rate(self, rate_text):
+        self.rate_var.set(rate_text)
+        self.rate_label.update()
+        self.tk_root.update()
+
+
+    def step_progress(self):
+        assert self.n_rule_items is not None
+
+        self.n_rule_items_done += 1
+        self._update_progress()
+
+
     def final_notifications(self, verbose=False):
         self.tk_root.destroy()
         self.tk_root = None
@@ -247,6 +352,30 @@ class ProgressGUI:
         self._init_state_vars()
         
 
+    def show_warning(self, message):
+        messagebox.showwarning(title='USB Copy Utility Warning',
+            message=message
+        )
+        self.tk_root.update()
+
+
+    def ask_retry_no_space(self, dst_items, estr):
+        """
+        Returns whether the user wants to retry copying dst_items, after
+        freeing space at their destination.
+        """
+        retry = messagebox.askretrycancel(
+            title='USB Copy Utility: Out of Space',
+            message=f'Ran out of space copying to {", ".join(dst_items)} '
+                f'({estr}).',
+            detail='Copying is paused. Free up space at the destination, then '
+                'press Retry to continue where it stopped, or Cancel to stop '
+                'copying.'
+        )
+        self.tk_root.update()
+        return retry
+
+
     def destroy(self):
         self.tk_root.destroy()
         self.tk_root = None
@@ -5,7 +5,6 @@ from os.path import join, split, exists, isdir, getmtime
 import sys
 import logging
 import logging.handlers
-import glob
 import time
 from shutil import copytree, copy2
 import traceback
@@ -32,6 +31,8 @@ import yaml
 import pytimeparse
 
 import util
+import copy_engine
+import source_scan
 
 GUID_DEVINTERFACE_USB_DEVICE = "{A5DCBF10-6530-11D2-901F-00C04FB951ED}"
 DBT_DEVICEARRIVAL = 0x8000
@@ -91,8 +92,13 @@ def load_config():
     if max_age_s is None:
         raise ValueError('could not parse ignore_files_older_than value')
     l.info(f'max age for copy: {max_age_s} seconds')
+
+    # Whether to copy items under a hidden name, only renaming them once they
+    # have been completely copied.
+    staging = data.get('staging', True)
+    l.info(f'staging: {staging}')
     
-    return ignore_drive_letters, copy_rules, max_age_s
+    return ignore_drive_letters, copy_rules, max_age_s, staging
 
 
 def get_drive_labels2roots(ignore_drive_letters, copy_rules):
@@ -183,7 +189,7 @@ def copy_all_by_rules():
     use_gui = True
     l.info(f'entering copy_all_by_rules (use_gui={use_gui})')
     
-    ignore_drive_letters, copy_rules, max_age_s = load_config()
+    ignore_drive_letters, copy_rules, max_age_s, staging = load_config()
     
     drive_labels2roots = \
         get_drive_labels2roots(ignore_drive_letters, copy_rules)
@@ -239,6 +245,17 @@ def copy_all_by_rules():
                     'drive_label': label
                 })
             
+        # All rules reading from the same source directory share one walk of
+        # it.
+        src2walk = dict()
+        for rn, rule in enumerate(rules):
+            if rule['from'] not in src2walk:
+                src2walk[rule['from']] = source_scan.SourceWalk(rule['from'])
+
+            src2walk[rule['from']].add_rule(rn,
+                source_scan.rule_selector(rule)
+            )
+
         for rn, rule in enumerate(rules):
             rule_start_time = time.time()
             
@@ -248,34 +265,50 @@ def copy_all_by_rules():
             # TODO maybe also show these errors in the gui
             if not isdir(src):
                 l.error(f'rule source {src} was not an existing directory')
+                src2walk[src].drop_rule(rn)
                 continue
                 
             dst = join(root, dst)
             if not isdir(dst):
                 l.error(f'rule destination {dst} was not an existing directory'
                 )
+                src2walk[src].drop_rule(rn)
                 continue
                 
             l.info(f'trying to copy items under {src} to {dst}, '
                 f'for drive {label}'
             )
+
+            # So each "is it already there?" check below doesn't need to hit
+            # the drive again.
+            dst_index = copy_engine.DestinationIndex(dst)
+
+            # Exclude patterns also apply to what is under the (directory)
+            # items.
+            ignore = copy_engine.copytree_ignore(
+                source_scan.rule_selector(rule).excluder(src)
+            )
             
-            if 'glob' in rule:
-                globstr = rule['glob']
-            else:
-                globstr = '*'
-                
             # TODO some nice call to recursively update (skip existing files,
             # or those w/ equally recent (m?)time?)
             
             # For now, only recursively copying over top-level items that do
             # not already exist at the destination.
             
-            glob_items = glob.glob(join(src, globstr))
-
             # Filtering these out first so progress bar is more meaningful.
             filtered_glob_items = []
-            for src_item in glob_items:
+            names = set()
+            for entry in src2walk[src].items(rn):
+                src_item = entry.path
+                # Items selected from different subdirectories (with **) can
+                # have the same name.
+                if entry.name in names:
+                    l.error(f'not copying {src_item}, because an item named '
+                        f'{entry.name} was already copied by this rule'
+                    )
+                    continue
+                names.add(entry.name)
+
                 src_item_age_s = current_time_s - getmtime(src_item)
                 if max_age_s > 0 and src_item_age_s > max_age_s:
                     l.info(f'skipping {src_item} because it was too old '
@@ -285,13 +318,33 @@ def copy_all_by_rules():
 
                 #  TODO compare mtimes here to decide whether to copy?
                 dst_item = join(dst, split(src_item)[1])
-                if not exists(dst_item):
+                if not dst_index.exists(dst_item):
                     filtered_glob_items.append(src_item)
                 else:
                     l.info(f'{dst_item} already existed at destination')
                 del dst_item
             glob_items = filtered_glob_items
+
+            # Staged copies of items about to be copied are removed (and
+            # started over) below, so anything else still staged is left from
+            # an earlier copy of an item this rule will not copy.
+            to_copy = {join(dst, split(src_item)[1]) for src_item in glob_items}
+            for staged, dst_item in dst_index.staged():
+                if dst_item in to_copy:
+                    continue
+
+                if dst_index.exists(dst_item):
+                    l.info(f'removing leftover {staged} ({dst_item} is '
+                        'complete)'
+                    )
+                    copy_engine.remove_path(staged)
+                    dst_index.discard(staged)
+                else:
+                    l.error(f'found incomplete copy {staged}, which this rule '
+                        'will not copy again'
+                    )
             
+            l.info(dst_index.summary())
             if len(glob_items) == 0:
                 l.info(f'no items to copy for rule {rn}!')
                 continue
@@ -317,14 +370,29 @@ def copy_all_by_rules():
                     
                 before_copy = time.time()
                 try:
-                    assert not exists(dst_item), \
+                    assert not dst_index.exists(dst_item), \
                         f'{dst_item} existed before copy'
+
+                    if staging:
+                        copy_dst = copy_engine.staging_path(dst_item)
+                        # Nothing to resume from here, so just starting over.
+                        if dst_index.exists(copy_dst):
+                            l.info(f'removing incomplete copy {copy_dst}')
+                            copy_engine.remove_path(copy_dst)
+                    else:
+                        copy_dst = dst_item
                         
                     if isdir(src_item):
-                        copytree(src_item, dst_item)
+                        copytree(src_item, copy_dst, ignore=ignore)
                     else:
                         # Assuming it was a file here.
-                        copy2(src_item, dst_item)
+                        copy2(src_item, copy_dst)
+
+                    if staging:
+                        os.rename(copy_dst, dst_item)
+                        dst_index.discard(copy_dst)
+
+                    dst_index.add(dst_item)
                         
                     copy_duration_s = time.time() - before_copy
                     l.info(f'copying {src_item} took {copy_duration_s:.2f}s')